@@ -0,0 +1,285 @@
+"""
+Bulk analysis of JSONL/CSV feedback corpora.
+
+Records are streamed from the input file through a bounded worker pool, so
+memory stays flat however large the file is. Results are appended to a CSV in
+the submitted_feedback.csv layout. Progress is checkpointed next to the output
+file, and a crashed run resumes where it stopped without duplicating rows.
+
+CLI usage (from backend/):
+    python batch.py reviews.jsonl results.csv [--workers 4] [--retries 2]
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime
+
+from models import FeedbackInput, AnalysisResult
+from pipeline import (MODEL_NAME, OLLAMA_URL, analyze_with_llm_async, analysis_cache_key, fallback_result,
+                      is_cacheable_result, is_error_result)
+from llm_client import AdmissionQueue, QueueFullError
+from router import LLMRouter
+from cache import AnalysisCache
+from preclassifier import PRECLASSIFIER_ENABLED, PreClassifier
+from tracing import log_event
+
+BATCH_WORKERS = int(os.getenv("TP_RIS_BATCH_WORKERS", "2"))
+BATCH_MAX_RETRIES = int(os.getenv("TP_RIS_BATCH_MAX_RETRIES", "2"))
+# Write a checkpoint after this many records or seconds, whichever comes first.
+CHECKPOINT_EVERY = 50
+CHECKPOINT_INTERVAL = 5.0
+
+OUTPUT_COLUMNS = ["timestamp", "feedback_text", "observation", "feeling", "need", "request", "trust_score"]
+TEXT_FIELDS = ("review_text", "feedback_text", "text", "body")
+
+
+def _parse_jsonl_line(line: str):
+    try:
+        row = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    return row if isinstance(row, dict) else None
+
+
+def iter_records(path: str):
+    """
+    Yield FeedbackInput-compatible dicts from a .csv or .jsonl file, one at a time.
+    Records without usable review text are yielded as None so they keep their index.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (_parse_jsonl_line(line) for line in f if line.strip())
+        for row in rows:
+            text = next((row[field] for field in TEXT_FIELDS if row.get(field)), "") if row else ""
+            if not isinstance(text, str) or not text.strip():
+                yield None
+                continue
+            rating = row.get("rating")
+            yield {"review_text": text, "rating": int(rating) if str(rating).isdigit() else None}
+
+
+class BatchStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.processed = 0
+        self.succeeded = 0
+        self.skipped = 0  # already done in a previous run
+        self.retries = 0
+        self.failures = Counter()
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "processed": self.processed,
+            "succeeded": self.succeeded,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "failures": dict(self.failures),
+            "elapsed_s": round(elapsed, 1),
+            "reviews_per_sec": round(self.processed / elapsed, 3) if elapsed else 0.0,
+        }
+
+
+class _Checkpoint:
+    """
+    Tracks which input records are done. Only records above the contiguous done
+    prefix are held individually, so its size is bounded by the worker pool.
+    Output and failure files are truncated back to the checkpointed offsets on
+    resume, which drops rows written after the last checkpoint.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.next_index = 0
+        self.done = set()
+        self.output_offset = 0
+        self.failed_offset = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.next_index = state["next_index"]
+            self.done = set(state["done"])
+            self.output_offset = state["output_offset"]
+            self.failed_offset = state["failed_offset"]
+
+    def is_done(self, index: int) -> bool:
+        return index < self.next_index or index in self.done
+
+    def mark(self, index: int):
+        self.done.add(index)
+        while self.next_index in self.done:
+            self.done.remove(self.next_index)
+            self.next_index += 1
+
+    def save(self, output_offset: int, failed_offset: int):
+        self.output_offset, self.failed_offset = output_offset, failed_offset
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "next_index": self.next_index,
+                "done": sorted(self.done),
+                "output_offset": output_offset,
+                "failed_offset": failed_offset,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def _open_for_resume(path: str, offset: int):
+    f = open(path, "r+b" if os.path.exists(path) else "w+b")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def _csv_line(values: list) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode("utf-8")
+
+
+def _result_row(text: str, result: AnalysisResult) -> list:
+    ofnr = result.ofnr_d
+    return [datetime.now().isoformat(), text, ofnr.observation, ofnr.feeling, ofnr.need, ofnr.request,
+            result.trust_assessment.trust_score]
+
+
+async def analyze_with_retries(input_data: FeedbackInput, client: LLMRouter, stats: BatchStats,
+                               cache: AnalysisCache = None, max_retries: int = BATCH_MAX_RETRIES,
+                               preclassifier: PreClassifier = None) -> AnalysisResult:
+    shortcut = preclassifier.classify(input_data) if preclassifier else None
+    if shortcut is not None:
+        return shortcut
+
+    result = None
+    for attempt in range(max_retries + 1):
+        final_attempt = attempt == max_retries
+        if attempt:
+            stats.retries += 1
+        try:
+            if cache is not None:
+                result = await cache.get_or_compute(
+                    analysis_cache_key(input_data, client.primary_models),
+                    lambda: analyze_with_llm_async(input_data, client),
+                    cacheable=is_cacheable_result,
+                )
+            else:
+                result = await analyze_with_llm_async(input_data, client)
+        except QueueFullError as e:
+            # Kept apart from real failures so per-flag stats show when the queue was the problem
+            result = fallback_result("queue_full", "Model server stayed busy") if final_attempt else None
+            if not final_attempt:
+                await asyncio.sleep(e.retry_after)
+            continue
+        if not is_error_result(result):
+            return result
+        if not final_attempt:
+            await asyncio.sleep(min(2 ** attempt, 30))
+    return result
+
+
+async def run_batch(input_path: str, output_path: str, client: LLMRouter, cache: AnalysisCache = None,
+                    workers: int = BATCH_WORKERS, max_retries: int = BATCH_MAX_RETRIES,
+                    preclassifier: PreClassifier = None, stats: BatchStats = None) -> BatchStats:
+    """Analyze every record of input_path into output_path, resuming from a previous checkpoint if present."""
+    stats = stats or BatchStats()
+    checkpoint = _Checkpoint(output_path + ".checkpoint.json")
+    output = _open_for_resume(output_path, checkpoint.output_offset)
+    failed = _open_for_resume(output_path + ".failed.jsonl", checkpoint.failed_offset)
+    if checkpoint.output_offset == 0:
+        output.write(_csv_line(OUTPUT_COLUMNS))
+
+    queue = asyncio.Queue(maxsize=workers * 2)
+    last_saved = {"count": 0, "at": time.monotonic()}
+
+    def save_checkpoint():
+        output.flush()
+        failed.flush()
+        os.fsync(output.fileno())
+        os.fsync(failed.fileno())
+        checkpoint.save(output.tell(), failed.tell())
+        last_saved.update(count=stats.processed, at=time.monotonic())
+
+    async def produce():
+        for index, record in enumerate(iter_records(input_path)):
+            if checkpoint.is_done(index):
+                stats.skipped += 1
+                continue
+            await queue.put((index, record))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, record = item
+            if record is None:
+                result = fallback_result("invalid_record", "Record has no review text")
+            else:
+                result = await analyze_with_retries(FeedbackInput(**record), client, stats, cache, max_retries,
+                                                    preclassifier)
+
+            if record is None or is_error_result(result):
+                stats.failures.update(result.trust_assessment.flags)
+                # Same shape as an input record, so the failures file can be fed back in as-is
+                failed.write((json.dumps({"index": index, **(record or {}), "flags": result.trust_assessment.flags,
+                                          "rationale": result.decision.rationale}) + "\n").encode("utf-8"))
+            else:
+                stats.succeeded += 1
+                output.write(_csv_line(_result_row(record["review_text"], result)))
+            stats.processed += 1
+            checkpoint.mark(index)
+
+            if (stats.processed - last_saved["count"] >= CHECKPOINT_EVERY
+                    or time.monotonic() - last_saved["at"] >= CHECKPOINT_INTERVAL):
+                save_checkpoint()
+                log_event("batch_progress", input=input_path, **stats.as_dict())
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(work()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        save_checkpoint()
+        output.close()
+        failed.close()
+
+    log_event("batch_finished", input=input_path, **stats.as_dict())
+    return stats
+
+
+async def _main(args):
+    client = LLMRouter.from_env(OLLAMA_URL, MODEL_NAME,
+                                AdmissionQueue(max_concurrency=args.workers, max_queue_size=args.workers))
+    cache = AnalysisCache(db_path=args.cache_db) if args.cache_db else None
+    try:
+        preclassifier = PreClassifier.from_env() if PRECLASSIFIER_ENABLED and not args.no_preclassifier else None
+        await run_batch(args.input, args.output, client, cache, workers=args.workers, max_retries=args.retries,
+                        preclassifier=preclassifier)
+    finally:
+        await client.aclose()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze a JSONL or CSV feedback corpus with the TP-RIS pipeline.")
+    parser.add_argument("input", help="input .jsonl or .csv file (review_text or feedback_text per record)")
+    parser.add_argument("output", help="output .csv in the submitted_feedback.csv layout; re-run to resume")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="parallel generations")
+    parser.add_argument("--retries", type=int, default=BATCH_MAX_RETRIES, help="retries per failed review")
+    parser.add_argument("--cache-db", default=None, help="sqlite analysis cache shared across runs")
+    parser.add_argument("--no-preclassifier", action="store_true", help="send every review to the LLM")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,178 @@
+"""
+Micro-benchmark and fuzz check for the JSON extraction stage of the pipeline.
+
+Usage (from backend/):
+    python benchmarks/bench_extract_json.py [--fuzz 2000] [--seed 0]
+
+Checks every entry of corpus/llm_outputs.jsonl against its expected decision,
+fuzzes mutated copies of the corpus to make sure extraction never raises, and
+times extract_json_object against the previous restart-at-every-brace extractor
+on increasingly long outputs: rambling ones, ones with unclosed braces, and ones
+full of objects that look like JSON but don't parse.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import extract_json_object  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "llm_outputs.jsonl")
+
+
+def legacy_extract_complete_json(text: str) -> str:
+    """The extractor this stage used before: rescans from every '{' and json.loads every candidate."""
+    candidates = []
+    start = 0
+    while True:
+        start_idx = text.find('{', start)
+        if start_idx == -1:
+            break
+        brace_count = 0
+        in_string = False
+        escape_next = False
+        for i, char in enumerate(text[start_idx:], start_idx):
+            if escape_next:
+                escape_next = False
+                continue
+            if char == '\\':
+                escape_next = True
+                continue
+            if char == '"' and not escape_next:
+                in_string = not in_string
+                continue
+            if in_string:
+                continue
+            if char == '{':
+                brace_count += 1
+            elif char == '}':
+                brace_count -= 1
+                if brace_count == 0:
+                    candidates.append(text[start_idx:i+1])
+                    break
+        start = start_idx + 1
+
+    required_keys = ['ofnr_d', 'trust_assessment', 'decision', 'rewrite']
+    best_candidate = ""
+    best_score = 0
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+            if isinstance(parsed, dict):
+                score = sum(1 for key in required_keys if key in parsed)
+                if score > best_score:
+                    best_score = score
+                    best_candidate = candidate
+        except Exception:
+            continue
+    return best_candidate
+
+
+def load_corpus():
+    with open(CORPUS_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def decision_action(parsed):
+    if not parsed or not isinstance(parsed.get("decision"), dict):
+        return None
+    return parsed["decision"].get("action")
+
+
+def check_corpus(corpus) -> int:
+    failures = 0
+    for entry in corpus:
+        action = decision_action(extract_json_object(entry["output"]))
+        ok = action == entry["expect_action"]
+        failures += not ok
+        print(f"  {'ok  ' if ok else 'FAIL'} {entry['name']:<28} expected={entry['expect_action']} got={action}")
+    return failures
+
+
+def mutate(text: str, rng: random.Random) -> str:
+    kind = rng.randrange(5)
+    if kind == 0:  # truncation, as when the model hits its token limit
+        return text[:rng.randrange(len(text) + 1)]
+    if kind == 1:  # stray structural characters
+        pos = rng.randrange(len(text) + 1)
+        return text[:pos] + rng.choice('{}[]"\\,:`') + text[pos:]
+    if kind == 2:  # dropped character
+        pos = rng.randrange(max(1, len(text)))
+        return text[:pos] + text[pos+1:]
+    if kind == 3:  # chatter before and after
+        return "Okay, thinking about it {step 1}...\n" + text + "\n```\nDone } {"
+    return text * rng.randint(2, 4)  # the model repeating itself
+
+
+def fuzz(corpus, iterations: int, seed: int) -> int:
+    rng = random.Random(seed)
+    errors = 0
+    for _ in range(iterations):
+        text = mutate(rng.choice(corpus)["output"], rng)
+        try:
+            parsed = extract_json_object(text)
+            assert parsed is None or isinstance(parsed, dict)
+        except Exception as e:
+            errors += 1
+            print(f"  extractor raised {type(e).__name__}: {e!r} on {text[:80]!r}")
+    return errors
+
+
+def rambling_output(corpus, target_len: int) -> str:
+    """A long response: chatter full of small nested objects with the real answer at the end."""
+    well_formed = next(e["output"] for e in corpus if e["name"] == "well_formed")
+    filler = 'Considering {"aside": {"depth": {"x": [1, {"y": 2}]}}} and {note} again. '
+    return filler * max(1, target_len // len(filler)) + well_formed
+
+
+def stray_brace_output(corpus, target_len: int) -> str:
+    """A long response whose reasoning opens braces it never closes, before the real answer."""
+    well_formed = next(e["output"] for e in corpus if e["name"] == "well_formed")
+    filler = "Step {n: weigh tone vs content, then "
+    return filler * max(1, target_len // len(filler)) + well_formed
+
+
+def invalid_object_output(corpus, target_len: int) -> str:
+    """A long response full of quoted objects that don't parse, before the real answer."""
+    well_formed = next(e["output"] for e in corpus if e["name"] == "well_formed")
+    filler = '{"a": x} '
+    return filler * max(1, target_len // len(filler)) + well_formed
+
+
+def bench(corpus):
+    scenarios = [("rambling", rambling_output), ("stray braces", stray_brace_output),
+                 ("invalid quoted", invalid_object_output)]
+    print(f"  {'scenario':<16} {'length':>8} {'legacy ms':>10} {'single-pass ms':>15} {'speedup':>8}")
+    for name, build in scenarios:
+        for target_len in (1_000, 5_000, 20_000):
+            text = build(corpus, target_len)
+            runs = max(1, 20_000 // target_len)
+            legacy = min(timeit.repeat(lambda: legacy_extract_complete_json(text), number=runs, repeat=3)) / runs
+            current = min(timeit.repeat(lambda: extract_json_object(text), number=runs, repeat=3)) / runs
+            print(f"  {name:<16} {len(text):>8} {legacy * 1000:>10.2f} {current * 1000:>15.2f} {legacy / current:>7.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fuzz", type=int, default=2000, help="number of mutated outputs to try")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    print(f"Corpus ({len(corpus)} outputs):")
+    failures = check_corpus(corpus)
+    print(f"Fuzzing {args.fuzz} mutated outputs (seed {args.seed})...")
+    errors = fuzz(corpus, args.fuzz, args.seed)
+    print(f"  {errors} extractor errors")
+    print("Extraction time per output:")
+    bench(corpus)
+
+    sys.exit(1 if failures or errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Stand-in for an Ollama server, for load-testing the backend without a GPU.
+
+Speaks /api/generate (streaming NDJSON and non-streaming) and answers with
+outputs drawn from corpus/llm_outputs.jsonl: well-formed, fenced, truncated,
+list-valued rewrites and so on. Latency follows a simple model: the prompt is
+prefilled at --prefill-ms per token and the answer decoded at --token-ms per
+token. At most --slots generations run at once and the rest wait, like
+OLLAMA_NUM_PARALLEL. Like Ollama's prompt cache, each slot remembers the last
+prompt it rendered (system + prompt), and the longest prefix a new prompt shares
+with any of them costs no prefill.
+
+Usage (from backend/):
+    python benchmarks/fake_ollama.py [--port 11434] [--slots 1] [--prefill-ms 0.5] [--token-ms 20]
+                                     [--outputs well_formed,fenced,truncated]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "llm_outputs.jsonl")
+CHARS_PER_TOKEN = 4
+
+config = argparse.Namespace(slots=1, prefill_ms=0.5, token_ms=20.0, load_ms=0.0, outputs=None, seed=None)
+state = {"semaphore": None, "outputs": [], "slot_prompts": deque(maxlen=1), "rng": random.Random()}
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def split_tokens(text: str) -> list:
+    return [text[i:i+CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def load_outputs(names):
+    with open(CORPUS_PATH) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if names:
+        entries = [entry for entry in entries if entry["name"] in names]
+    if not entries:
+        raise SystemExit(f"No corpus outputs match {names}")
+    return [entry["output"] for entry in entries]
+
+
+def render_prompt(body: dict) -> str:
+    system = body.get("system") or ""
+    return f"{system}\n\n{body.get('prompt', '')}" if system else body.get("prompt", "")
+
+
+def prefill_tokens(body: dict) -> int:
+    """Tokens to prefill: the rendered prompt minus the longest prefix a slot still holds."""
+    rendered = render_prompt(body)
+    cached = max((len(os.path.commonprefix([rendered, seen])) for seen in state["slot_prompts"]), default=0)
+    state["slot_prompts"].append(rendered)
+    return max(1, count_tokens(rendered) - cached // CHARS_PER_TOKEN)
+
+
+def final_chunk(body: dict, prompt_tokens: int, eval_tokens: int, started: float, prefill_s: float,
+                eval_s: float) -> dict:
+    return {
+        "model": body.get("model"),
+        "response": "",
+        "done": True,
+        "done_reason": "stop",
+        "total_duration": int((time.monotonic() - started) * 1e9),
+        "load_duration": int(config.load_ms * 1e6),
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": int(prefill_s * 1e9),
+        "eval_count": eval_tokens,
+        "eval_duration": int(eval_s * 1e9),
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state["semaphore"] = asyncio.Semaphore(config.slots)
+    state["slot_prompts"] = deque(maxlen=config.slots)
+    state["outputs"] = load_outputs(config.outputs)
+    state["rng"] = random.Random(config.seed)
+    yield
+
+
+app = FastAPI(title="Fake Ollama", lifespan=lifespan)
+
+
+@app.get("/")
+async def root():
+    return "Ollama is running"
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": "fake", "model": "fake"}]}
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    output = state["rng"].choice(state["outputs"])
+    tokens = split_tokens(output)
+    options = body.get("options") or {}
+    if options.get("num_predict"):
+        tokens = tokens[:options["num_predict"]]
+    started = time.monotonic()
+
+    if body.get("stream", True):
+        async def stream():
+            async with state["semaphore"]:
+                prompt_tokens = prefill_tokens(body)
+                prefill_s = prompt_tokens * config.prefill_ms / 1000
+                await asyncio.sleep(config.load_ms / 1000 + prefill_s)
+                eval_started = time.monotonic()
+                for token in tokens:
+                    await asyncio.sleep(config.token_ms / 1000)
+                    yield json.dumps({"model": body.get("model"), "response": token, "done": False}) + "\n"
+                yield json.dumps(final_chunk(body, prompt_tokens, len(tokens), started, prefill_s,
+                                             time.monotonic() - eval_started)) + "\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    async with state["semaphore"]:
+        prompt_tokens = prefill_tokens(body)
+        prefill_s = prompt_tokens * config.prefill_ms / 1000
+        await asyncio.sleep(config.load_ms / 1000 + prefill_s)
+        eval_started = time.monotonic()
+        generated = 0
+        for _ in tokens:
+            # Like Ollama, stop generating (and free the slot) once the client has gone
+            if await request.is_disconnected():
+                return {}
+            await asyncio.sleep(config.token_ms / 1000)
+            generated += 1
+    return {**final_chunk(body, prompt_tokens, generated, started, prefill_s, time.monotonic() - eval_started),
+            "response": "".join(tokens)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--slots", type=int, default=1, help="parallel generations, like OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="prefill latency per prompt token")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="decode latency per generated token")
+    parser.add_argument("--load-ms", type=float, default=0.0, help="extra latency per request (model load)")
+    parser.add_argument("--outputs", default=None, help="comma-separated corpus entry names to answer with")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config.slots, config.prefill_ms, config.token_ms = args.slots, args.prefill_ms, args.token_ms
+    config.load_ms, config.seed = args.load_ms, args.seed
+    config.outputs = set(args.outputs.split(",")) if args.outputs else None
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Load generator for the backend: drives /analyze-feedback (or the streaming
+endpoint) at a fixed concurrency and reports throughput, latency percentiles,
+HTTP status codes and pipeline error flags.
+
+Usage (from backend/, with the backend and benchmarks/fake_ollama.py running):
+    python benchmarks/load_test.py --concurrency 8 --requests 200 --save baseline.json
+    python benchmarks/load_test.py --concurrency 8 --requests 200 --baseline baseline.json
+
+Review texts come from submitted_feedback.csv. By default every request gets a
+unique suffix so the analysis cache does not hide the pipeline cost; pass
+--allow-cache-hits to replay texts as-is.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "submitted_feedback.csv")
+ERROR_FLAGS = ("connection_error", "json_parse_error", "system_error", "queue_full")
+
+
+def load_texts(path: str) -> list:
+    with open(path, newline="", encoding="utf-8") as f:
+        return [row["feedback_text"] for row in csv.DictReader(f) if row.get("feedback_text", "").strip()]
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def one_request(client: httpx.AsyncClient, url: str, text: str, stream: bool) -> dict:
+    started = time.perf_counter()
+    record = {"status": None, "flags": [], "latency": None, "time_to_decision": None}
+    try:
+        if stream:
+            async with client.stream("POST", url, json={"review_text": text}) as response:
+                record["status"] = response.status_code
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event in ("field", "result"):
+                        data = json.loads(line[len("data: "):])
+                        if event == "field" and data["field"] == "decision" and record["time_to_decision"] is None:
+                            record["time_to_decision"] = time.perf_counter() - started
+                        if event == "result":
+                            record["flags"] = data["result"]["trust_assessment"]["flags"]
+        else:
+            response = await client.post(url, json={"review_text": text})
+            record["status"] = response.status_code
+            if response.status_code == 200:
+                record["flags"] = response.json()["trust_assessment"]["flags"]
+    except httpx.HTTPError as e:
+        record["status"] = type(e).__name__
+    record["latency"] = time.perf_counter() - started
+    return record
+
+
+async def run_load(args) -> dict:
+    texts = load_texts(args.corpus)
+    url = args.url.rstrip("/") + ("/analyze-feedback/stream" if args.stream else "/analyze-feedback")
+    run_id = uuid.uuid4().hex[:8]
+    records = []
+    next_index = {"value": 0}
+
+    async def worker(client):
+        while next_index["value"] < args.requests:
+            i = next_index["value"]
+            next_index["value"] += 1
+            text = texts[i % len(texts)]
+            if not args.allow_cache_hits:
+                text = f"{text} (load test {run_id}-{i})"
+            records.append(await one_request(client, url, text, args.stream))
+
+    started = time.perf_counter()
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    ok_latencies = sorted(r["latency"] for r in records if r["status"] == 200)
+    decisions = sorted(r["time_to_decision"] for r in records if r["time_to_decision"] is not None)
+    flags = Counter(flag for r in records for flag in r["flags"])
+    statuses = Counter(str(r["status"]) for r in records)
+    pipeline_errors = sum(1 for r in records if any(flag in ERROR_FLAGS for flag in r["flags"]))
+    failed = sum(1 for r in records if r["status"] != 200) + pipeline_errors
+
+    report = {
+        "endpoint": url,
+        "concurrency": args.concurrency,
+        "requests": len(records),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(records) / elapsed, 3),
+        "latency_ms": {
+            "p50": round(percentile(ok_latencies, 50) * 1000, 1),
+            "p90": round(percentile(ok_latencies, 90) * 1000, 1),
+            "p99": round(percentile(ok_latencies, 99) * 1000, 1),
+            "max": round((ok_latencies[-1] if ok_latencies else 0) * 1000, 1),
+        },
+        "error_rate": round(failed / (len(records) or 1), 4),
+        "status_codes": dict(statuses),
+        "flags": dict(flags),
+    }
+    if decisions:
+        report["time_to_decision_ms"] = {
+            "p50": round(percentile(decisions, 50) * 1000, 1),
+            "p99": round(percentile(decisions, 99) * 1000, 1),
+        }
+    return report
+
+
+def compare(report: dict, baseline: dict):
+    """Print how the headline numbers moved relative to a saved baseline."""
+    def change(new, old, lower_is_better):
+        if not old:
+            return "n/a"
+        delta = (new - old) / old * 100
+        better = delta < 0 if lower_is_better else delta > 0
+        return f"{delta:+.1f}% ({'better' if better else 'worse' if delta else 'same'})"
+
+    print("Compared with baseline:")
+    print(f"  throughput   {baseline['throughput_rps']:>10} -> {report['throughput_rps']:<10} "
+          f"{change(report['throughput_rps'], baseline['throughput_rps'], False)}")
+    for pct in ("p50", "p90", "p99"):
+        old, new = baseline["latency_ms"][pct], report["latency_ms"][pct]
+        print(f"  latency {pct}  {old:>10} -> {new:<10} {change(new, old, True)}")
+    print(f"  error rate   {baseline['error_rate']:>10} -> {report['error_rate']:<10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="backend base URL")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--stream", action="store_true", help="use /analyze-feedback/stream")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="CSV with a feedback_text column")
+    parser.add_argument("--allow-cache-hits", action="store_true")
+    parser.add_argument("--timeout", type=float, default=130.0)
+    parser.add_argument("--save", help="write the report as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="JSON report from an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args))
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from models import AnalysisResult
+
+CACHE_MAX_ENTRIES = int(os.getenv("TP_RIS_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("TP_RIS_CACHE_TTL", "86400"))
+# Path to a sqlite file for the on-disk tier. Leave unset to keep the cache in memory only.
+CACHE_DB_PATH = os.getenv("TP_RIS_CACHE_DB_PATH") or None
+
+
+class AnalysisCache:
+    """
+    Two-tier cache of AnalysisResults: an in-memory LRU with TTL in front of an
+    optional sqlite store that survives restarts. Concurrent misses on the same key
+    share a single computation.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 db_path: Optional[str] = CACHE_DB_PATH):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._pending = {}
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _remember(self, key: str, result: AnalysisResult, created: float):
+        self._memory[key] = (result, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[AnalysisResult]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            result, created = entry
+            if not self._expired(created):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return result.model_copy(deep=True)
+            del self._memory[key]
+            self.expirations += 1
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT value, created FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                value, created = row
+                if not self._expired(created):
+                    result = AnalysisResult.model_validate_json(value)
+                    self._remember(key, result, created)
+                    self.disk_hits += 1
+                    return result.model_copy(deep=True)
+                self._db.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._db.commit()
+                self.expirations += 1
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: AnalysisResult):
+        created = time.time()
+        self._remember(key, result.model_copy(deep=True), created)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, value, created) VALUES (?, ?, ?)",
+                (key, result.model_dump_json(), created),
+            )
+            self._db.commit()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[AnalysisResult]],
+                             cacheable: Callable[[AnalysisResult], bool] = lambda result: True) -> AnalysisResult:
+        """Return the cached result for key, or run compute once for all concurrent callers."""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        entry = self._pending.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            entry["waiters"] += 1
+        else:
+            task = asyncio.ensure_future(compute())
+            entry = {"task": task, "waiters": 1}
+            self._pending[key] = entry
+
+            def _finish(done: asyncio.Future):
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                if not done.cancelled() and done.exception() is None and cacheable(done.result()):
+                    self.put(key, done.result())
+
+            task.add_done_callback(_finish)
+
+        try:
+            result = await asyncio.shield(entry["task"])
+        except asyncio.CancelledError:
+            # Only abandon the shared computation once every caller waiting on it is gone.
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                entry["task"].cancel()
+            raise
+        entry["waiters"] -= 1
+        return result.model_copy(deep=True)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "disk_enabled": self._db is not None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "in_flight": len(self._pending),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
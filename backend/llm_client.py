@@ -0,0 +1,294 @@
+import asyncio
+import json
+import math
+import os
+import time
+from contextlib import asynccontextmanager, nullcontext
+from typing import Optional
+
+import httpx
+
+from metrics import (LLM_UPSTREAM_DURATION, OLLAMA_EVAL_DURATION, OLLAMA_EVAL_TOKENS, OLLAMA_PROMPT_EVAL_DURATION,
+                     OLLAMA_PROMPT_TOKENS, QUEUE_WAIT)
+from tracing import log_event
+
+# Number of generations we let run against the model server at once. This should
+# match the server's parallel slots (OLLAMA_NUM_PARALLEL), anything above that just
+# queues inside Ollama where we can't see or bound it.
+MAX_CONCURRENCY = int(os.getenv("TP_RIS_MAX_CONCURRENCY", "1"))
+# How many requests may wait for a free slot before we start rejecting new ones.
+MAX_QUEUE_SIZE = int(os.getenv("TP_RIS_MAX_QUEUE_SIZE", "8"))
+# Longest a request may sit in the queue before it is rejected.
+QUEUE_TIMEOUT = float(os.getenv("TP_RIS_QUEUE_TIMEOUT", "30"))
+REQUEST_TIMEOUT = float(os.getenv("TP_RIS_REQUEST_TIMEOUT", "120"))
+
+OLLAMA_TIMING_FIELDS = ("load_duration", "prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration")
+
+
+class QueueFullError(Exception):
+    """Raised when a request cannot be admitted to the model server."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Model server is busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    """Bounded wait queue in front of a fixed number of generation slots."""
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, max_queue_size: int = MAX_QUEUE_SIZE,
+                 queue_timeout: float = QUEUE_TIMEOUT):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue_size = max(0, max_queue_size)
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        # Exponential moving average of slot hold time, used for Retry-After hints.
+        self.avg_service_time = 0.0
+
+    def retry_after(self) -> int:
+        waves = (self.queued + self.in_flight) / self.max_concurrency
+        return max(1, math.ceil(waves * (self.avg_service_time or 1.0)))
+
+    @asynccontextmanager
+    async def slot(self, record: bool = True):
+        """Hold a generation slot; record=False leaves it out of the wait/service-time stats."""
+        if self._semaphore.locked() and self.queued >= self.max_queue_size:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+
+        self.queued += 1
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+        finally:
+            self.queued -= 1
+        if record:
+            QUEUE_WAIT.observe(time.monotonic() - enqueued)
+
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if record:
+                elapsed = time.monotonic() - started
+                self.avg_service_time = elapsed if not self.completed else 0.8 * self.avg_service_time + 0.2 * elapsed
+                self.completed += 1
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_service_time_s": round(self.avg_service_time, 3),
+        }
+
+
+class OllamaClient:
+    """Shared keep-alive connection pool to the model server, gated by an AdmissionQueue."""
+
+    GENERATE_PATH = "/api/generate"
+    PROBE_PATH = "/api/tags"
+
+    def __init__(self, url: str, queue: AdmissionQueue = None, timeout: float = REQUEST_TIMEOUT,
+                 headers: dict = None):
+        self.url = url
+        self.queue = queue or AdmissionQueue()
+        self.cancelled_generations = 0
+        self.cancelled_queued = 0
+        self.estimated_tokens_saved = 0
+        # Moving average of Ollama's eval_count, used to estimate what a cancelled generation would have cost.
+        self.avg_eval_tokens = 0.0
+        self._eval_samples = 0
+        # Running totals of the timing fields Ollama reports per generation (durations in ns).
+        self.ollama_totals = {field: 0 for field in OLLAMA_TIMING_FIELDS}
+        pool_size = self.queue.max_concurrency
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers=headers,
+        )
+
+    def _request_body(self, payload: dict) -> dict:
+        return payload
+
+    def _parse_response(self, data: dict) -> dict:
+        return data
+
+    def _parse_stream_line(self, line: str) -> Optional[dict]:
+        return json.loads(line) if line.strip() else None
+
+    def _record_timings(self, result_data: dict):
+        if "eval_count" not in result_data:
+            return
+        eval_count = result_data["eval_count"]
+        self._eval_samples += 1
+        self.avg_eval_tokens = eval_count if self._eval_samples == 1 else 0.8 * self.avg_eval_tokens + 0.2 * eval_count
+        for field in OLLAMA_TIMING_FIELDS:
+            self.ollama_totals[field] += result_data.get(field, 0)
+        OLLAMA_PROMPT_TOKENS.observe(result_data.get("prompt_eval_count", 0))
+        OLLAMA_EVAL_TOKENS.observe(eval_count)
+        # OpenAI-compatible servers report token counts but no durations
+        if "eval_duration" in result_data:
+            OLLAMA_PROMPT_EVAL_DURATION.observe(result_data.get("prompt_eval_duration", 0) / 1e9)
+            OLLAMA_EVAL_DURATION.observe(result_data["eval_duration"] / 1e9)
+        log_event("ollama_timings",
+                  load_ms=round(result_data.get("load_duration", 0) / 1e6, 1),
+                  prompt_eval_tokens=result_data.get("prompt_eval_count", 0),
+                  prompt_eval_ms=round(result_data.get("prompt_eval_duration", 0) / 1e6, 1),
+                  eval_tokens=eval_count,
+                  eval_ms=round(result_data.get("eval_duration", 0) / 1e6, 1))
+
+    def timing_stats(self) -> dict:
+        """Average per-generation prefill (prompt_eval) and decode (eval) cost as reported by Ollama."""
+        samples = self._eval_samples or 1
+        totals = self.ollama_totals
+        return {
+            "generations": self._eval_samples,
+            "avg_load_ms": round(totals["load_duration"] / samples / 1e6, 1),
+            "avg_prompt_eval_tokens": round(totals["prompt_eval_count"] / samples, 1),
+            "avg_prompt_eval_ms": round(totals["prompt_eval_duration"] / samples / 1e6, 1),
+            "avg_eval_tokens": round(totals["eval_count"] / samples, 1),
+            "avg_eval_ms": round(totals["eval_duration"] / samples / 1e6, 1),
+        }
+
+    async def generate(self, payload: dict, record_stats: bool = True) -> dict:
+        """
+        POST a generation request. Cancelling the calling task closes the upstream
+        connection, which makes Ollama abort the generation and free its slot.
+        With record_stats=False (warm-up) the generation still takes a slot but is
+        left out of the timing stats, EMAs and metrics.
+        """
+        started = False
+        try:
+            async with self.queue.slot(record=record_stats):
+                started = True
+                with LLM_UPSTREAM_DURATION.time(mode="generate") if record_stats else nullcontext():
+                    response = await self._client.post(self.url, json=self._request_body(payload))
+                    response.raise_for_status()
+                    result_data = self._parse_response(response.json())
+        except asyncio.CancelledError:
+            if not record_stats:
+                raise
+            if started:
+                self.cancelled_generations += 1
+                self.estimated_tokens_saved += round(self.avg_eval_tokens)
+                log_event("generation_cancelled", estimated_tokens_saved=round(self.avg_eval_tokens))
+            else:
+                self.cancelled_queued += 1
+            raise
+
+        if record_stats:
+            self._record_timings(result_data)
+        return result_data
+
+    async def generate_stream(self, payload: dict):
+        """
+        Streaming variant of generate: yields each NDJSON chunk Ollama sends
+        ({"response": "<token>", "done": false, ...}). Closing or cancelling the
+        iterator aborts the upstream generation.
+        """
+        started = False
+        finished = False
+        tokens_seen = 0
+        try:
+            async with self.queue.slot():
+                started = True
+                upstream_started = time.perf_counter()
+                body = self._request_body({**payload, "stream": True})
+                async with self._client.stream("POST", self.url, json=body) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        chunk = self._parse_stream_line(line)
+                        if chunk is None:
+                            continue
+                        tokens_seen += 1
+                        if chunk.get("done"):
+                            finished = True
+                            LLM_UPSTREAM_DURATION.observe(time.perf_counter() - upstream_started, mode="stream")
+                            self._record_timings(chunk)
+                        yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            if finished:
+                raise
+            if started:
+                saved = max(0, round(self.avg_eval_tokens) - tokens_seen)
+                self.cancelled_generations += 1
+                self.estimated_tokens_saved += saved
+                log_event("generation_cancelled", tokens_generated=tokens_seen, estimated_tokens_saved=saved)
+            else:
+                self.cancelled_queued += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            **self.queue.stats(),
+            "cancelled_generations": self.cancelled_generations,
+            "cancelled_queued": self.cancelled_queued,
+            "estimated_tokens_saved": self.estimated_tokens_saved,
+            "avg_eval_tokens": round(self.avg_eval_tokens, 1),
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class OpenAIClient(OllamaClient):
+    """
+    OllamaClient for OpenAI-compatible servers (vLLM, LM Studio, llama.cpp server).
+    Takes the same Ollama-style payloads and returns Ollama-shaped responses and
+    chunks, so callers don't need to know which kind of server they talk to.
+    """
+
+    GENERATE_PATH = "/v1/chat/completions"
+    PROBE_PATH = "/v1/models"
+
+    def _request_body(self, payload: dict) -> dict:
+        messages = [{"role": "user", "content": payload.get("prompt", "")}]
+        if payload.get("system"):
+            messages.insert(0, {"role": "system", "content": payload["system"]})
+        options = payload.get("options") or {}
+        body = {"model": payload["model"], "messages": messages, "stream": payload.get("stream", False)}
+        if "temperature" in options:
+            body["temperature"] = options["temperature"]
+        if options.get("num_predict"):
+            body["max_tokens"] = options["num_predict"]
+        if body["stream"]:
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    @staticmethod
+    def _usage_fields(usage: dict) -> dict:
+        return {"prompt_eval_count": usage.get("prompt_tokens", 0), "eval_count": usage.get("completion_tokens", 0)}
+
+    def _parse_response(self, data: dict) -> dict:
+        message = data["choices"][0]["message"]
+        return {"model": data.get("model"), "response": message.get("content") or "", "done": True,
+                **self._usage_fields(data.get("usage") or {})}
+
+    def _parse_stream_line(self, line: str) -> Optional[dict]:
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        data = json.loads(data)
+        choices = data.get("choices") or []
+        delta = (choices[0].get("delta") or {}) if choices else {}
+        chunk = {"model": data.get("model"), "response": delta.get("content") or "", "done": False}
+        # The usage chunk comes last, so it plays the role of Ollama's final "done" chunk
+        if data.get("usage"):
+            chunk.update(done=True, **self._usage_fields(data["usage"]))
+        return chunk
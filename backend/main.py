@@ -1,9 +1,44 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, File, Header, HTTPException, Request, Response, UploadFile
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from models import FeedbackInput, AnalysisResult
-from pipeline import analyze_with_llm
+from pipeline import (MODEL_NAME, OLLAMA_URL, analyze_with_llm_async, analysis_cache_key, is_cacheable_result,
+                      stream_analysis_events, warm_up)
+from llm_client import QueueFullError
+from router import LLMRouter
+from cache import AnalysisCache
+from batch import BatchStats, run_batch
+from preclassifier import PRECLASSIFIER_ENABLED, PreClassifier
+from metrics import render_gauges, render_metrics
+from tracing import RequestTracingMiddleware, log_event
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.llm_client = LLMRouter.from_env(OLLAMA_URL, MODEL_NAME)
+    app.state.llm_client.start()
+    app.state.analysis_cache = AnalysisCache()
+    app.state.batch_jobs = {}
+    app.state.preclassifier = PreClassifier.from_env() if PRECLASSIFIER_ENABLED else None
+    # Don't hold up startup on model loading; requests arriving meanwhile simply queue behind it
+    warm_up_task = asyncio.ensure_future(warm_up(app.state.llm_client))
+    yield
+    warm_up_task.cancel()
+    for job in app.state.batch_jobs.values():
+        job["task"].cancel()
+    await asyncio.gather(*(job["task"] for job in app.state.batch_jobs.values()), return_exceptions=True)
+    await app.state.llm_client.aclose()
+    app.state.analysis_cache.close()
 
-app = FastAPI(title="TP-RIS Offline Backend")
+app = FastAPI(title="TP-RIS Offline Backend", lifespan=lifespan)
 
 # Setup CORS for local React frontend - allow all origins for local development
 app.add_middleware(
@@ -13,18 +48,244 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestTracingMiddleware)
+
+# How often a pending request checks whether its client has gone away.
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# Latest in-progress analysis per X-Session-Id; a newer request from the same session cancels the older one.
+_session_tasks = {}
+# Why we cancelled a task ("disconnected" or "superseded"), so its CancelledError can be told
+# apart from the request handler itself being cancelled.
+_cancel_reasons = {}
+
+async def run_until_disconnected(request: Request, coro, session_id: Optional[str] = None):
+    """
+    Run coro as a task and cancel it as soon as the client disconnects or, when a
+    session id is given, a newer request from the same session arrives.
+    Returns (result, reason); reason is None on success, else "disconnected" or "superseded".
+    """
+    task = asyncio.ensure_future(coro)
+    if session_id:
+        previous = _session_tasks.get(session_id)
+        if previous is not None and not previous.done():
+            _cancel_reasons[previous] = "superseded"
+            previous.cancel()
+        _session_tasks[session_id] = task
+
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                break
+            if await request.is_disconnected():
+                _cancel_reasons[task] = "disconnected"
+                task.cancel()
+                break
+        try:
+            return await task, None
+        except asyncio.CancelledError:
+            reason = _cancel_reasons.get(task)
+            if reason is None:
+                raise
+            return None, reason
+    finally:
+        if not task.done():
+            task.cancel()
+        _cancel_reasons.pop(task, None)
+        if session_id and _session_tasks.get(session_id) is task:
+            del _session_tasks[session_id]
 
 @app.post("/analyze-feedback", response_model=AnalysisResult)
-async def analyze_feedback_endpoint(input_data: FeedbackInput):
+async def analyze_feedback_endpoint(input_data: FeedbackInput, request: Request,
+                                    x_session_id: Optional[str] = Header(default=None)):
     """
     Analyzes feedback text using the local TP-RIS pipeline.
     """
     if not input_data.review_text.strip():
         raise HTTPException(status_code=400, detail="Review text cannot be empty.")
-    
-    result = analyze_with_llm(input_data)
+
+    preclassifier = request.app.state.preclassifier
+    shortcut = preclassifier.classify(input_data) if preclassifier else None
+    if shortcut is not None:
+        return shortcut
+
+    client = request.app.state.llm_client
+    try:
+        result, cancelled = await run_until_disconnected(
+            request,
+            request.app.state.analysis_cache.get_or_compute(
+                analysis_cache_key(input_data, client.primary_models),
+                lambda: analyze_with_llm_async(input_data, client),
+                cacheable=is_cacheable_result,
+            ),
+            session_id=x_session_id,
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    if cancelled == "superseded":
+        raise HTTPException(status_code=409, detail="Superseded by a newer request from this session.")
+    if cancelled == "disconnected":
+        # Nobody is listening; 499 is nginx's "client closed request".
+        return Response(status_code=499)
     return result
 
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/analyze-feedback/stream")
+async def analyze_feedback_stream_endpoint(input_data: FeedbackInput, request: Request):
+    """
+    Server-Sent Events variant of /analyze-feedback. Emits "started", one "field"
+    event per completed AnalysisResult field (so decision arrives before the
+    rewrite is written) and a final "result" event with the validated result.
+    """
+    if not input_data.review_text.strip():
+        raise HTTPException(status_code=400, detail="Review text cannot be empty.")
+
+    cache = request.app.state.analysis_cache
+    client = request.app.state.llm_client
+    cache_key = analysis_cache_key(input_data, client.primary_models)
+    preclassifier = request.app.state.preclassifier
+    ready = preclassifier.classify(input_data) if preclassifier else None
+    if ready is None:
+        ready = cache.get(cache_key)
+
+    if ready is not None:
+        async def replay_ready():
+            for field, value in ready.model_dump(exclude={"served_model"}).items():
+                yield format_sse("field", {"field": field, "value": value, "elapsed_ms": 0})
+            yield format_sse("result", {"result": ready.model_dump(), "cached": True,
+                                        "time_to_first_token_ms": 0, "time_to_decision_ms": 0, "total_ms": 0,
+                                        "retract": False, "retracted_fields": []})
+        return StreamingResponse(replay_ready(), media_type="text/event-stream")
+
+    events = stream_analysis_events(input_data, client)
+    try:
+        # Wait for admission and the first token up front so overload can still be answered with a 503
+        first_event, cancelled = await run_until_disconnected(request, events.__anext__())
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if cancelled:
+        return Response(status_code=499)
+
+    async def relay():
+        # Starlette cancels this generator when the client disconnects, which closes the upstream stream.
+        yield format_sse(*first_event)
+        async for event, data in events:
+            if event == "result":
+                result = AnalysisResult(**data["result"])
+                if is_cacheable_result(result):
+                    cache.put(cache_key, result)
+            yield format_sse(event, data)
+
+    return StreamingResponse(relay(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Uploaded corpora, results and checkpoints of batch jobs live in one directory per job id
+BATCH_DIR = os.getenv("TP_RIS_BATCH_DIR", os.path.join(tempfile.gettempdir(), "tp-ris-batches"))
+
+def _batch_paths(job_id: str):
+    if len(job_id) != 32 or not all(c in "0123456789abcdef" for c in job_id):
+        raise HTTPException(status_code=404, detail="Unknown batch job.")
+    job_dir = os.path.join(BATCH_DIR, job_id)
+    inputs = [name for name in os.listdir(job_dir) if name.startswith("input.")] if os.path.isdir(job_dir) else []
+    input_path = os.path.join(job_dir, inputs[0]) if inputs else None
+    return input_path, os.path.join(job_dir, "results.csv")
+
+def _start_batch_job(app: FastAPI, job_id: str):
+    input_path, output_path = _batch_paths(job_id)
+    job = {"status": "running", "error": None, "stats": BatchStats()}
+
+    async def run():
+        try:
+            await run_batch(input_path, output_path, app.state.llm_client, app.state.analysis_cache,
+                            preclassifier=app.state.preclassifier, stats=job["stats"])
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "interrupted"
+            raise
+        except Exception as e:
+            log_event("batch_failed", logging.ERROR, job_id=job_id, error=str(e))
+            job["status"], job["error"] = "failed", str(e)
+
+    job["task"] = asyncio.ensure_future(run())
+    app.state.batch_jobs[job_id] = job
+
+def _batch_job_response(job_id: str, job: dict) -> dict:
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "error": job["error"],
+        "stats": job["stats"].as_dict(),
+        "results_url": f"/analyze-feedback/batch/{job_id}/results",
+    }
+
+@app.post("/analyze-feedback/batch", status_code=202)
+async def analyze_feedback_batch_endpoint(request: Request, file: UploadFile = File(...)):
+    """
+    Starts a background analysis of an uploaded .jsonl or .csv corpus. Poll
+    /analyze-feedback/batch/{job_id} for progress and download the results CSV
+    from /analyze-feedback/batch/{job_id}/results.
+    """
+    extension = os.path.splitext(file.filename or "")[1].lower()
+    if extension not in (".jsonl", ".csv"):
+        raise HTTPException(status_code=400, detail="Upload a .jsonl or .csv file.")
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(BATCH_DIR, job_id))
+    with open(os.path.join(BATCH_DIR, job_id, "input" + extension), "wb") as f:
+        while chunk := await file.read(1 << 20):
+            f.write(chunk)
+
+    _start_batch_job(request.app, job_id)
+    return _batch_job_response(job_id, request.app.state.batch_jobs[job_id])
+
+@app.get("/analyze-feedback/batch/{job_id}")
+async def batch_status_endpoint(job_id: str, request: Request):
+    job = request.app.state.batch_jobs.get(job_id)
+    if job is None:
+        if _batch_paths(job_id)[0] is None:
+            raise HTTPException(status_code=404, detail="Unknown batch job.")
+        # Started before the last restart; POST .../resume to continue it
+        return {"job_id": job_id, "status": "interrupted", "error": None, "stats": None,
+                "results_url": f"/analyze-feedback/batch/{job_id}/results"}
+    return _batch_job_response(job_id, job)
+
+@app.post("/analyze-feedback/batch/{job_id}/resume", status_code=202)
+async def batch_resume_endpoint(job_id: str, request: Request):
+    job = request.app.state.batch_jobs.get(job_id)
+    if job is not None and job["status"] == "running":
+        raise HTTPException(status_code=409, detail="Batch job is already running.")
+    if _batch_paths(job_id)[0] is None:
+        raise HTTPException(status_code=404, detail="Unknown batch job.")
+    _start_batch_job(request.app, job_id)
+    return _batch_job_response(job_id, request.app.state.batch_jobs[job_id])
+
+@app.get("/analyze-feedback/batch/{job_id}/results")
+async def batch_results_endpoint(job_id: str):
+    output_path = _batch_paths(job_id)[1]
+    if not os.path.exists(output_path):
+        raise HTTPException(status_code=404, detail="No results for this batch job yet.")
+    return FileResponse(output_path, media_type="text/csv", filename=f"{job_id}.csv")
+
 @app.get("/health")
-async def health_check():
-    return {"status": "ok", "system": "TP-RIS-Offline"}
+async def health_check(request: Request):
+    return {
+        "status": "ok",
+        "system": "TP-RIS-Offline",
+        "queue": request.app.state.llm_client.stats(),
+        "ollama": request.app.state.llm_client.timing_stats(),
+        "cache": request.app.state.analysis_cache.stats(),
+        "preclassifier": request.app.state.preclassifier.stats() if request.app.state.preclassifier else None,
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request):
+    """Prometheus text-format metrics: per-stage latency histograms, decision/error counters, queue and cache gauges."""
+    state = request.app.state
+    extra = render_gauges("tp_ris_queue", state.llm_client.stats()) + render_gauges("tp_ris_cache", state.analysis_cache.stats())
+    if state.preclassifier:
+        extra += render_gauges("tp_ris_preclassifier", state.preclassifier.stats())
+    return PlainTextResponse(render_metrics(extra), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,140 @@
+"""
+Minimal Prometheus metrics, rendered in the text exposition format by /metrics.
+
+Metrics are module-level singletons so any stage of the pipeline can record
+into them without threading a registry around.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from fast in-process stages (JSON extraction) up to nginx's 120s proxy timeout
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+_REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render_gauges(prefix: str, stats: dict) -> list:
+    """Expose the numeric fields of a component's stats() dict as gauges."""
+    lines = []
+    for field, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{field}"
+        lines += [f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+    return lines
+
+
+def render_metrics(extra_lines: list = ()) -> str:
+    lines = []
+    for metric in _REGISTRY:
+        lines += metric.render()
+    lines += extra_lines
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_DURATION = Histogram(
+    "tp_ris_request_duration_seconds", "Total time spent serving an HTTP request.", ("endpoint", "status"))
+QUEUE_WAIT = Histogram(
+    "tp_ris_queue_wait_seconds", "Time a generation waited for a free model slot.")
+LLM_UPSTREAM_DURATION = Histogram(
+    "tp_ris_llm_upstream_seconds", "Time from sending a generation to Ollama until its full response arrived.",
+    ("mode",))
+OLLAMA_PROMPT_EVAL_DURATION = Histogram(
+    "tp_ris_ollama_prompt_eval_seconds", "Prefill time reported by Ollama (prompt_eval_duration).")
+OLLAMA_EVAL_DURATION = Histogram(
+    "tp_ris_ollama_eval_seconds", "Decode time reported by Ollama (eval_duration).")
+OLLAMA_PROMPT_TOKENS = Histogram(
+    "tp_ris_ollama_prompt_eval_tokens", "Prompt tokens Ollama had to evaluate (prompt_eval_count).",
+    buckets=TOKEN_BUCKETS)
+OLLAMA_EVAL_TOKENS = Histogram(
+    "tp_ris_ollama_eval_tokens", "Tokens Ollama generated (eval_count).", buckets=TOKEN_BUCKETS)
+JSON_EXTRACTION_DURATION = Histogram(
+    "tp_ris_json_extraction_seconds", "Time spent extracting the JSON object from model output.")
+VALIDATION_DURATION = Histogram(
+    "tp_ris_validation_seconds", "Time spent validating the extracted JSON into an AnalysisResult.")
+DECISIONS = Counter(
+    "tp_ris_decisions_total", "Analyses produced, by decision action and by what produced them.", ("action", "source"))
+ERRORS = Counter(
+    "tp_ris_errors_total", "Analyses that failed, by error flag.", ("flag",))
+BACKEND_REQUESTS = Counter(
+    "tp_ris_backend_requests_total", "Generations routed to each model backend, by outcome.",
+    ("backend", "model", "outcome"))
+CIRCUIT_BREAKER_OPENED = Counter(
+    "tp_ris_circuit_breaker_opened_total", "Times a backend's circuit breaker opened after repeated failures.",
+    ("backend",))
@@ -47,3 +47,4 @@ class AnalysisResult(BaseModel):
     trust_assessment: TrustAssessment
     decision: Decision
     rewrite: Rewrite
+    served_model: Optional[str] = None  # model that produced the analysis, when it came from an LLM
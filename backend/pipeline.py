@@ -1,9 +1,33 @@
+import bisect
+import hashlib
 import json
-import requests
-from models import FeedbackInput, AnalysisResult
+import logging
+import os
+import re
+import time
+import unicodedata
+import httpx
+from typing import Optional
+from pydantic import ValidationError
+from models import FeedbackInput, AnalysisResult, Decision, OFNRDComponents, Rewrite, TrustAssessment
+from llm_client import QueueFullError
+from metrics import DECISIONS, ERRORS, JSON_EXTRACTION_DURATION, VALIDATION_DURATION
+from router import LLMRouter
+from tracing import log_event
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
-MODEL_NAME = "gpt-oss:20b"
+# Single model server used when TP_RIS_BACKENDS does not configure a pool (see router.py).
+OLLAMA_URL = os.getenv("TP_RIS_OLLAMA_URL", "http://localhost:11434/api/generate")
+MODEL_NAME = os.getenv("TP_RIS_MODEL", "gpt-oss:20b")
+
+# Send SYSTEM_PROMPT in Ollama's separate `system` field so every request starts with
+# the same token prefix and the server can reuse its cached prefill. Set to 0 to go
+# back to one concatenated prompt.
+PREFIX_REUSE = os.getenv("TP_RIS_PREFIX_REUSE", "1") != "0"
+# How long Ollama keeps the model (and its prompt cache) loaded after the last request; "-1" = forever.
+KEEP_ALIVE = os.getenv("TP_RIS_KEEP_ALIVE", "30m")
+# Optional JSONL file that every successful LLM analysis is appended to (review text + decision),
+# used to train and evaluate the pre-classifier.
+RESULT_LOG_PATH = os.getenv("TP_RIS_RESULT_LOG") or None
 
 SYSTEM_PROMPT = """You are an expert Academic Review Assistant. Your role is to help users provide constructive, professional, and actionable feedback in an academic or professional setting.
 
@@ -69,150 +93,433 @@ TEXT: "{data.review_text}"
 
 Return ONLY a complete JSON object with ofnr_d, trust_assessment, decision, and rewrite:"""
 
-def extract_complete_json(text: str) -> str:
-    """Extract the most complete JSON object containing all required keys."""
-    candidates = []
-    start = 0
-    
+# Fingerprint of everything that shapes the model's answer besides the review text.
+# Editing the prompts changes it, so stale cached analyses are never served.
+PROMPT_FINGERPRINT = hashlib.sha256(
+    (SYSTEM_PROMPT + build_user_prompt(FeedbackInput(review_text=""))).encode("utf-8")
+).hexdigest()
+
+# Flags set by fallback_result; results carrying them must not be cached.
+ERROR_FLAGS = {"connection_error", "json_parse_error", "system_error", "queue_full"}
+
+def normalize_review_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def analysis_cache_key(input_data: FeedbackInput, models: tuple = (MODEL_NAME,)) -> str:
+    """Key on the models that can serve the request (LLMRouter.primary_models), the prompt and the text."""
+    key_material = "\0".join([*models, PROMPT_FINGERPRINT, normalize_review_text(input_data.review_text)])
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+# Set on results a fallback-tier backend produced because the primary ones were down or overloaded.
+FALLBACK_FLAG = "fallback_model"
+
+def is_error_result(result: AnalysisResult) -> bool:
+    return bool(ERROR_FLAGS.intersection(result.trust_assessment.flags))
+
+def is_cacheable_result(result: AnalysisResult) -> bool:
+    # Degraded answers from a fallback model shouldn't outlive the overload that caused them
+    return not is_error_result(result) and FALLBACK_FLAG not in result.trust_assessment.flags
+
+REQUIRED_KEYS = ('ofnr_d', 'trust_assessment', 'decision', 'rewrite')
+
+def _score(obj: dict) -> int:
+    return sum(1 for key in REQUIRED_KEYS if key in obj)
+
+def _best_nested(obj: dict):
+    """Best-scoring dict inside obj (itself included), for outputs wrapped like {"result": {...}}."""
+    best, best_score = obj, _score(obj)
+    stack = [obj]
+    while stack and best_score < len(REQUIRED_KEYS):
+        for value in stack.pop().values():
+            if isinstance(value, dict):
+                score = _score(value)
+                if score > best_score:
+                    best, best_score = value, score
+                stack.append(value)
+    return best, best_score
+
+# A structural character, and a JSON string (which can't span a line) with what must follow it
+_JSON_TOKEN = re.compile(r'[{}"]')
+_JSON_STRING = re.compile(r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"')
+_AFTER_STRING = re.compile(r'\s*(?:[:,}\]]|$)')
+
+def _balanced_objects(text: str) -> list:
+    """
+    (start, end, depth) of every balanced {...}, by start. Depth 0 is outermost,
+    not counting braces that are never closed (prose or a truncated object).
+
+    A quote that opens a string which doesn't end on its line, or isn't followed by
+    ':', ',', '}' or ']', broke quote parity (a truncated first attempt, or a quote
+    in chatter). The scan then treats it as prose and goes on from just after it,
+    keeping the open braces. The text up to where the break showed is rescanned at
+    most once, and past that the scan only moves forward, so the pass stays linear.
+    """
+    open_braces = []
+    closed = []  # (start, end, depth at close) of every balanced object
+    rescanned_upto = 0
+    pos = 0
+
     while True:
-        start_idx = text.find('{', start)
-        if start_idx == -1:
+        if not open_braces:
+            pos = text.find('{', pos)
+            if pos == -1:
+                break
+        match = _JSON_TOKEN.search(text, pos)
+        if match is None:
             break
-            
-        brace_count = 0
-        in_string = False
-        escape_next = False
-        
-        for i, char in enumerate(text[start_idx:], start_idx):
-            if escape_next:
-                escape_next = False
+        token, pos = match.group(), match.start()
+        if token == '{':
+            open_braces.append(pos)
+            pos += 1
+        elif token == '}':
+            if open_braces:
+                start_idx = open_braces.pop()
+                closed.append((start_idx, pos, len(open_braces)))
+            pos += 1
+        else:
+            string = _JSON_STRING.match(text, pos)
+            if string is not None and _AFTER_STRING.match(text, string.end()):
+                pos = string.end()
                 continue
-            if char == '\\':
-                escape_next = True
-                continue
-            if char == '"' and not escape_next:
-                in_string = not in_string
-                continue
-            if in_string:
-                continue
-            if char == '{':
-                brace_count += 1
-            elif char == '}':
-                brace_count -= 1
-                if brace_count == 0:
-                    candidate = text[start_idx:i+1]
-                    candidates.append(candidate)
-                    break
-        
-        start = start_idx + 1
-    
-    required_keys = ['ofnr_d', 'trust_assessment', 'decision', 'rewrite']
-    best_candidate = ""
-    best_score = 0
-    
-    for candidate in candidates:
+            if string is not None:
+                broken_at = string.end() - 1  # its closing quote opens the next string
+            else:
+                broken_at = text.find('\n', pos)
+                broken_at = len(text) if broken_at == -1 else broken_at
+            if pos >= rescanned_upto:
+                pos, rescanned_upto = pos + 1, broken_at
+            else:
+                pos = broken_at
+
+    # Braces still open at the end are strays, and the only ones that can enclose an object
+    closed.sort()
+    return [(start_idx, end_idx, depth - bisect.bisect_left(open_braces, start_idx))
+            for start_idx, end_idx, depth in closed]
+
+def extract_json_object(text: str) -> Optional[dict]:
+    """
+    Return the parsed JSON object that contains the most required keys, or None.
+
+    One linear pass finds the balanced objects (see _balanced_objects). Outermost
+    ones are handed to json.loads in order; only when one doesn't parse are the
+    objects directly inside it tried. Markdown fences and chatter around the
+    objects are skipped, and quotes outside any object are ignored.
+    """
+    objects = _balanced_objects(text)
+    best, best_score = None, 0
+    pending = [i for i in range(len(objects) - 1, -1, -1) if objects[i][2] == 0]
+    while pending:
+        i = pending.pop()
+        start_idx, end_idx, depth = objects[i]
         try:
-            parsed = json.loads(candidate)
-            if isinstance(parsed, dict):
-                score = sum(1 for key in required_keys if key in parsed)
-                if score > best_score:
-                    best_score = score
-                    best_candidate = candidate
-        except:
+            parsed = json.loads(text[start_idx:end_idx+1])
+        except json.JSONDecodeError:
+            # e.g. {note: {...}}: the answer may still be inside
+            children = []
+            for j in range(i + 1, len(objects)):
+                if objects[j][0] > end_idx:
+                    break
+                if objects[j][2] == depth + 1:
+                    children.append(j)
+            pending.extend(reversed(children))
             continue
-    
-    return best_candidate
+        if not isinstance(parsed, dict):
+            continue
+        candidate, score = _best_nested(parsed)
+        if score > best_score:
+            best, best_score = candidate, score
+            if best_score == len(REQUIRED_KEYS):
+                return best
+
+    return best
 
-def analyze_with_llm(input_data: FeedbackInput) -> AnalysisResult:
+class JSONFieldStream:
     """
-    Orchestrates the TP-RIS analysis via Ollama.
+    Incrementally scans streamed model output and yields each top-level field of
+    the first JSON object with AnalysisResult fields as soon as its value is
+    complete. A '{' in chatter is dropped as soon as what follows it can't be an
+    object body, and a string running past the end of its line means quote parity
+    broke; either way the scan starts over at the next '{'. Each character is
+    looked at once, so feeding a whole response costs O(n).
     """
-    
+
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self._pos = 0
+        self._reset()
+
+    def _reset(self):
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self._keys = set()
+
+    def _complete_field(self, end: int, fields: list):
+        if self._key is not None and self._value_start is not None:
+            try:
+                fields.append((self._key, json.loads(self.text[self._value_start:end])))
+                self._keys.add(self._key)
+            except json.JSONDecodeError:
+                pass
+        self._key = None
+        self._value_start = None
+
+    def _close_object(self, end: int, fields: list):
+        self._complete_field(end, fields)
+        if self._keys.intersection(REQUIRED_KEYS):
+            self.done = True
+        else:
+            self._reset()  # e.g. {"note": 1} in chatter; the answer may still follow
+
+    def feed(self, chunk: str) -> list:
+        """Append chunk and return the (key, value) pairs completed by it."""
+        fields = []
+        self.text += chunk
+        text = self.text
+        i = self._pos
+        while i < len(text) and not self.done:
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        try:
+                            self._key = json.loads(text[self._key_start:i+1])
+                            self._key_start = None
+                        except json.JSONDecodeError:
+                            self._reset()
+                elif char == '\n':
+                    self._reset()  # JSON strings don't span lines, e.g. a truncated first attempt
+            elif self._depth == 0:
+                # Skip anything before the object, e.g. fences or preamble chatter
+                if char == '{':
+                    self._depth = 1
+            elif self._depth == 1 and self._value_start is None:
+                # Between fields only a key, its colon or the closing brace can follow
+                if char == '"' and self._key is None:
+                    self._in_string = True
+                    self._key_start = i
+                elif char == ':' and self._key is not None:
+                    self._value_start = i + 1
+                elif char == '}':
+                    self._close_object(i, fields)
+                elif not char.isspace():
+                    self._reset()  # not an object body, e.g. "Thinking { about the tone..."
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_object(i, fields)
+            elif self._depth == 1 and char == ',':
+                self._complete_field(i, fields)
+            i += 1
+        self._pos = i
+        return fields
+
+def build_generate_payload(input_data: FeedbackInput) -> dict:
     user_message = build_user_prompt(input_data)
-    full_prompt = f"{SYSTEM_PROMPT}\n\n{user_message}"
+    payload = {
+        "model": MODEL_NAME,
+        "stream": False,
+        "keep_alive": KEEP_ALIVE,
+        "options": {
+            "temperature": 0.5
+        }
+    }
+    if PREFIX_REUSE:
+        payload["system"] = SYSTEM_PROMPT
+        payload["prompt"] = user_message
+    else:
+        payload["prompt"] = f"{SYSTEM_PROMPT}\n\n{user_message}"
+    return payload
+
+async def warm_up(client: LLMRouter):
+    """Load each backend's model and prefill SYSTEM_PROMPT so the first real request only pays for its own text."""
+    payload = build_generate_payload(FeedbackInput(review_text="Warm-up."))
+    payload["options"]["num_predict"] = 1
+    # Left out of the timing stats: its full prefill would skew the numbers the prefix saving is checked with
+    outcomes = await client.generate_on_each(payload, record_stats=False)
+    for backend, outcome in zip(client.backends, outcomes):
+        if isinstance(outcome, Exception):
+            log_event("warm_up_failed", logging.WARNING, backend=backend.name, error=str(outcome))
+        else:
+            log_event("warm_up_done", backend=backend.name, prompt_eval_tokens=outcome.get("prompt_eval_count"),
+                      prompt_eval_ms=round(outcome.get("prompt_eval_duration", 0) / 1e6, 1))
+
+def record_served_model(result: AnalysisResult, response_data: dict):
+    """Note which model answered, flagging answers from a fallback backend."""
+    result.served_model = response_data.get("model", MODEL_NAME)
+    if response_data.get("fallback"):
+        result.trust_assessment.flags.append(FALLBACK_FLAG)
+
+def join_rewrite_text(rewrite: dict):
+    # FIX: Handle case where LLM returns a list of strings for rewrite.text
+    if rewrite.get('text') and isinstance(rewrite['text'], list):
+        log_event("rewrite_text_list_joined", items=len(rewrite['text']))
+        rewrite['text'] = "\n".join(rewrite['text'])
+
+# Sub-model each top-level AnalysisResult field must validate against before it is streamed.
+STREAMED_FIELD_MODELS = {
+    "ofnr_d": OFNRDComponents,
+    "trust_assessment": TrustAssessment,
+    "decision": Decision,
+    "rewrite": Rewrite,
+}
+
+def validate_streamed_field(key: str, value) -> Optional[dict]:
+    """The field normalized the way parse_llm_response would, or None if it isn't a valid AnalysisResult field."""
+    model = STREAMED_FIELD_MODELS.get(key)
+    if model is None or not isinstance(value, dict):
+        return None
+    if key == "rewrite":
+        join_rewrite_text(value)
+    try:
+        return model(**value).model_dump()
+    except ValidationError:
+        return None
+
+def parse_llm_response(raw_content: str) -> AnalysisResult:
+    """Turn the raw model output into a validated AnalysisResult."""
+    # Markdown fences and surrounding chatter are skipped by the extractor itself
+    with JSON_EXTRACTION_DURATION.time():
+        data_dict = extract_json_object(raw_content)
+
+    if data_dict is None:
+        log_event("json_not_found", logging.WARNING, response_chars=len(raw_content))
+        raise ValueError("No valid JSON found in LLM response")
+
+    log_event("json_extracted", response_chars=len(raw_content), keys=list(data_dict))
+
+    if 'decision' not in data_dict:
+        data_dict['decision'] = {'action': 'NO_OP', 'rationale': 'Analysis complete'}
+    if 'rewrite' not in data_dict:
+        data_dict['rewrite'] = {'text': None, 'explanation': None}
+
+    join_rewrite_text(data_dict['rewrite'])
+
+    with VALIDATION_DURATION.time():
+        validated_output = AnalysisResult(**data_dict)
+    DECISIONS.inc(action=validated_output.decision.action, source="llm")
+    log_event("analysis_parsed", action=validated_output.decision.action)
+    return validated_output
+
+def log_result(input_data: FeedbackInput, result: AnalysisResult):
+    if not RESULT_LOG_PATH:
+        return
+    record = {
+        "review_text": input_data.review_text,
+        "action": result.decision.action,
+        "trust_score": result.trust_assessment.trust_score,
+        "model": result.served_model or MODEL_NAME,
+    }
+    with open(RESULT_LOG_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+def fallback_result(flag: str, rationale: str) -> AnalysisResult:
+    """Empty NO_OP result carrying an error flag, returned when analysis fails."""
+    ERRORS.inc(flag=flag)
+    return AnalysisResult(
+        ofnr_d={
+            "observation": None, "feeling": None, "need": None, "request": None,
+            "confidence": {"observation": 0, "feeling": 0, "need": 0, "request": 0}
+        },
+        trust_assessment={"trust_score": 0.0, "flags": [flag]},
+        decision={"action": "NO_OP", "rationale": rationale},
+        rewrite={"text": None, "explanation": None}
+    )
+
+def failure_result(error: Exception) -> AnalysisResult:
+    """Log an analysis failure and turn it into the matching fallback_result."""
+    if isinstance(error, httpx.HTTPError):
+        flag, rationale = "connection_error", f"Could not connect to Ollama: {str(error)}"
+    elif isinstance(error, json.JSONDecodeError):
+        flag, rationale = "json_parse_error", "Failed to parse LLM response"
+    else:
+        flag, rationale = "system_error", f"System error: {str(error)}"
+    log_event("llm_error", logging.ERROR, flag=flag, error=str(error))
+    return fallback_result(flag, rationale)
+
+async def analyze_with_llm_async(input_data: FeedbackInput, client: LLMRouter) -> AnalysisResult:
+    """
+    Orchestrates the TP-RIS analysis through the shared client pool.
+    Raises QueueFullError when the request cannot be admitted.
+    """
     
-    print(f"[Pipeline] Sending prompt to Ollama ({MODEL_NAME})...")
+    log_event("llm_request", model=MODEL_NAME, stream=False)
     
     try:
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "prompt": full_prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.5
-                }
-            },
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        result_data = response.json()
-        raw_content = result_data.get("response", "").strip()
-        print(f"[Pipeline] Raw LLM response length: {len(raw_content)}")
-        
-        # Clean markdown fences if present
-        content = raw_content
-        if "```json" in content:
-            content = content.split("```json", 1)[-1]
-        if "```" in content:
-            content = content.split("```")[0]
-        
-        json_str = extract_complete_json(content)
-        
-        if not json_str:
-            print(f"[Pipeline] No valid JSON found in response")
-            raise ValueError("No valid JSON found in LLM response")
-        
-        print(f"[Pipeline] Extracted JSON length: {len(json_str)}")
-        
-        data_dict = json.loads(json_str)
-        
-        if 'decision' not in data_dict:
-            data_dict['decision'] = {'action': 'NO_OP', 'rationale': 'Analysis complete'}
-        if 'rewrite' not in data_dict:
-            data_dict['rewrite'] = {'text': None, 'explanation': None}
-        
-        # FIX: Handle case where LLM returns a list of strings for rewrite.text
-        if data_dict['rewrite'].get('text') and isinstance(data_dict['rewrite']['text'], list):
-            print(f"[Pipeline] Handling list output for rewrite.text: {data_dict['rewrite']['text']}")
-            data_dict['rewrite']['text'] = "\n".join(data_dict['rewrite']['text'])
-        
-        validated_output = AnalysisResult(**data_dict)
-        print(f"[Pipeline] Successfully parsed response, decision: {validated_output.decision.action}")
-        return validated_output
-
-    except requests.exceptions.RequestException as e:
-        print(f"[Pipeline] Ollama request error: {e}")
-        return AnalysisResult(
-            ofnr_d={
-                "observation": None, "feeling": None, "need": None, "request": None,
-                "confidence": {"observation": 0, "feeling": 0, "need": 0, "request": 0}
-            },
-            trust_assessment={"trust_score": 0.0, "flags": ["connection_error"]},
-            decision={"action": "NO_OP", "rationale": f"Could not connect to Ollama: {str(e)}"},
-            rewrite={"text": None, "explanation": None}
-        )
-    except json.JSONDecodeError as e:
-        print(f"[Pipeline] JSON parse error: {e}")
-        return AnalysisResult(
-            ofnr_d={
-                "observation": None, "feeling": None, "need": None, "request": None,
-                "confidence": {"observation": 0, "feeling": 0, "need": 0, "request": 0}
-            },
-            trust_assessment={"trust_score": 0.0, "flags": ["json_parse_error"]},
-            decision={"action": "NO_OP", "rationale": f"Failed to parse LLM response"},
-            rewrite={"text": None, "explanation": None}
-        )
+        result_data = await client.generate(build_generate_payload(input_data))
+        result = parse_llm_response(result_data.get("response", "").strip())
+        record_served_model(result, result_data)
+        log_result(input_data, result)
+        return result
+
+    except QueueFullError:
+        raise
     except Exception as e:
-        print(f"[Pipeline] Error during inference: {e}")
-        return AnalysisResult(
-            ofnr_d={
-                "observation": None, "feeling": None, "need": None, "request": None,
-                "confidence": {"observation": 0, "feeling": 0, "need": 0, "request": 0}
-            },
-            trust_assessment={"trust_score": 0.0, "flags": ["system_error"]},
-            decision={"action": "NO_OP", "rationale": f"System error: {str(e)}"},
-            rewrite={"text": None, "explanation": None}
-        )
+        return failure_result(e)
+
+async def stream_analysis_events(input_data: FeedbackInput, client: LLMRouter):
+    """
+    Streams the analysis as (event, data) pairs: a "started" event on the first
+    token, a "field" event per top-level AnalysisResult field as soon as it has
+    been generated and validated, and a final "result" event with the validated
+    AnalysisResult. The result event lists in "retracted_fields" any streamed field
+    the final result disagrees with (e.g. a draft object the model then redid).
+    Raises QueueFullError before the first event when the request is not admitted.
+    """
+    started_at = time.monotonic()
+    elapsed_ms = lambda: round((time.monotonic() - started_at) * 1000)
+    timings = {"time_to_first_token_ms": None, "time_to_decision_ms": None}
+    fields = JSONFieldStream()
+    streamed = {}
+    last_chunk = {}
+
+    log_event("llm_request", model=MODEL_NAME, stream=True)
+
+    try:
+        async for chunk in client.generate_stream(build_generate_payload(input_data)):
+            last_chunk = chunk
+            if timings["time_to_first_token_ms"] is None:
+                timings["time_to_first_token_ms"] = elapsed_ms()
+                yield "started", dict(timings)
+            for key, value in fields.feed(chunk.get("response", "")):
+                value = validate_streamed_field(key, value)
+                if value is None:
+                    continue
+                streamed[key] = value
+                if key == "decision" and timings["time_to_decision_ms"] is None:
+                    timings["time_to_decision_ms"] = elapsed_ms()
+                    log_event("decision_streamed", time_to_decision_ms=timings["time_to_decision_ms"])
+                yield "field", {"field": key, "value": value, "elapsed_ms": elapsed_ms()}
+        result = parse_llm_response(fields.text.strip())
+        # Compare with what was streamed before the fallback flag goes in; it isn't a change of answer
+        answered = result.model_dump()
+        record_served_model(result, last_chunk)
+        log_result(input_data, result)
+
+    except QueueFullError:
+        raise
+    except Exception as e:
+        result = failure_result(e)
+        answered = result.model_dump()
+
+    final = result.model_dump()
+    retracted = [key for key, value in streamed.items() if answered[key] != value]
+    if retracted:
+        log_event("streamed_fields_retracted", fields=retracted)
+        if "decision" in retracted:
+            timings["time_to_decision_ms"] = None
+    yield "result", {"result": final, **timings, "total_ms": elapsed_ms(),
+                     "retract": bool(retracted), "retracted_fields": retracted}
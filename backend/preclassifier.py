@@ -0,0 +1,370 @@
+"""
+Cheap CPU-only pre-classifier that answers obvious cases without the LLM.
+
+Two layers run in front of the model:
+  * rules for gibberish (FLAG) and very short text (SUGGEST_CLARIFICATION, off by
+    default); neither answers text with abusive words, however short
+  * a tiny softmax regression over lexical features and words, trained on the
+    decisions logged by the pipeline (TP_RIS_RESULT_LOG)
+
+Rule hits are taken when their rule is enabled (TP_RIS_PRECLASSIFIER_RULES). A model
+prediction is taken only when its action has a configured threshold and the
+confidence reaches it. Everything else escalates to the LLM.
+
+CLI usage (from backend/):
+    python preclassifier.py train results_log.jsonl [--model preclassifier_model.json]
+    python preclassifier.py evaluate results_log.jsonl [--model preclassifier_model.json]
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+from collections import Counter
+from typing import Optional
+
+from models import FeedbackInput, AnalysisResult
+from metrics import DECISIONS
+from tracing import log_event
+
+PRECLASSIFIER_ENABLED = os.getenv("TP_RIS_PRECLASSIFIER", "1") != "0"
+PRECLASSIFIER_MODEL_PATH = os.getenv(
+    "TP_RIS_PRECLASSIFIER_MODEL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "preclassifier_model.json")
+)
+# Minimum confidence per action before we answer without the LLM, e.g. "NO_OP=0.9,FLAG=0.95".
+# Actions that are not listed always escalate; rewrites need the LLM anyway.
+DEFAULT_THRESHOLDS = "NO_OP=0.9,FLAG=0.95,SUGGEST_CLARIFICATION=0.95"
+SHORTCUT_ACTIONS = ("NO_OP", "FLAG", "SUGGEST_CLARIFICATION")
+# Rules that may answer on their own, by the reason they report. Rules give a yes/no
+# rather than a confidence, so they are switched on or off instead of thresholded.
+# too_short stays off until evaluate shows it agrees with the LLM.
+DEFAULT_RULES = "gibberish"
+RULE_REASONS = ("gibberish", "too_short")
+
+MIN_WORDS = 4
+# Fewer word tokens than this are too little to call gibberish
+GIBBERISH_MIN_WORDS = 3
+# Texts with the rule outcome they should get, checked by evaluate
+RULE_CASES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "corpus",
+                               "preclassifier_rule_cases.jsonl")
+
+WORD_RE = re.compile(r"[a-z']+")
+CONSONANT_RUN_RE = re.compile(r"[bcdfghjklmnpqrstvwxz]{6,}")  # "strengths" has a run of five
+
+POLITE_WORDS = {"please", "thank", "thanks", "appreciate", "could", "would", "suggest", "consider", "helpful"}
+SPECIFIC_WORDS = {"section", "lecture", "assignment", "week", "example", "slide", "exam", "rubric", "chapter",
+                  "homework", "lab", "project", "deadline", "grading", "quiz", "tutorial", "module"}
+ABUSIVE_WORDS = {"idiot", "stupid", "moron", "dumb", "trash", "garbage", "hate", "useless", "pathetic",
+                 "incompetent", "shit", "fuck", "fucking", "crap", "damn", "sucks", "worst", "clown", "loser",
+                 "kys", "stfu", "asshole", "bitch"}
+
+
+def parse_thresholds(spec: str) -> dict:
+    thresholds = {}
+    for part in spec.split(","):
+        if "=" in part:
+            action, value = part.split("=", 1)
+            if action.strip() in SHORTCUT_ACTIONS:
+                thresholds[action.strip()] = float(value)
+    return thresholds
+
+
+def parse_rules(spec: str) -> set:
+    return {rule.strip() for rule in spec.split(",") if rule.strip() in RULE_REASONS}
+
+
+def _is_wordlike(word: str) -> bool:
+    if 2 <= len(word) <= 4 and word.isalpha():
+        return True  # shorthand without vowels: hw, pts, cs, ppt
+    return len(word) <= 20 and any(v in word for v in "aeiouy") and not CONSONANT_RUN_RE.search(word)
+
+
+def extract_features(text: str) -> dict:
+    """Sparse lexical feature vector: dense style features plus bag of words."""
+    lowered = text.lower()
+    words = WORD_RE.findall(lowered)
+    non_space = [c for c in text if not c.isspace()]
+    letters = [c for c in non_space if c.isalpha()]
+    n_words = len(words) or 1
+
+    features = {
+        "bias": 1.0,
+        "log_words": math.log1p(len(words)),
+        "alpha_ratio": len(letters) / (len(non_space) or 1),
+        "wordlike_ratio": sum(_is_wordlike(w) for w in words) / n_words,
+        "caps_ratio": sum(c.isupper() for c in letters) / (len(letters) or 1),
+        "exclamations": min(text.count("!"), 5) / 5,
+        "questions": min(text.count("?"), 5) / 5,
+        "digits": float(any(c.isdigit() for c in text)),
+        "polite": sum(w in POLITE_WORDS for w in words) / n_words,
+        "specific": sum(w in SPECIFIC_WORDS for w in words) / n_words,
+        "abusive": sum(w.strip("'") in ABUSIVE_WORDS for w in words) / n_words,
+        "second_person": sum(w in ("you", "your", "you're") for w in words) / n_words,
+    }
+    for word in set(words):
+        features["w=" + word] = 1.0
+    return features
+
+
+def rule_prediction(text: str):
+    """(action, reason) for cases rules settle on their own, else None."""
+    words = WORD_RE.findall(text.lower())
+    letters = sum(c.isalpha() for c in text)
+    if letters and sum(c.isascii() for c in text if c.isalpha()) < 0.5 * letters:
+        return None  # mostly non-Latin script, which these rules can't judge
+    if any(w.strip("'") in ABUSIVE_WORDS for w in words):
+        return None  # abuse is the LLM's call, however short
+    # Judged on word tokens only, so scores, dates and punctuation ("2/10 ... unfair!!!") don't count against it
+    if len(words) >= GIBBERISH_MIN_WORDS and sum(_is_wordlike(w) for w in words) / len(words) < 0.5:
+        return "FLAG", "gibberish"
+    if len(text.split()) < MIN_WORDS:
+        return "SUGGEST_CLARIFICATION", "too_short"
+    return None
+
+
+class SoftmaxModel:
+    """Multinomial logistic regression over sparse dict features, small enough to keep as JSON."""
+
+    def __init__(self, weights: dict = None):
+        self.weights = weights or {}  # action -> {feature: weight}
+
+    def predict_proba(self, features: dict) -> dict:
+        scores = {action: sum(w.get(f, 0.0) * v for f, v in features.items()) for action, w in self.weights.items()}
+        top = max(scores.values())
+        exp = {action: math.exp(score - top) for action, score in scores.items()}
+        total = sum(exp.values())
+        return {action: value / total for action, value in exp.items()}
+
+    def fit(self, samples: list, epochs: int = 20, learning_rate: float = 0.1, l2: float = 1e-4, seed: int = 0):
+        """samples: list of (features, action)."""
+        self.weights = {action: {} for action in {action for _, action in samples}}
+        rng = random.Random(seed)
+        order = list(range(len(samples)))
+        for _ in range(epochs):
+            rng.shuffle(order)
+            for i in order:
+                features, label = samples[i]
+                proba = self.predict_proba(features)
+                for action, w in self.weights.items():
+                    gradient = proba[action] - (1.0 if action == label else 0.0)
+                    for f, v in features.items():
+                        w[f] = w.get(f, 0.0) * (1 - learning_rate * l2) - learning_rate * gradient * v
+        # Drop near-zero weights so the saved model stays small
+        self.weights = {a: {f: round(v, 5) for f, v in w.items() if abs(v) > 1e-3} for a, w in self.weights.items()}
+        return self
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"weights": self.weights}, f)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f)["weights"])
+
+
+def _shortcut_result(action: str, confidence: Optional[float], reason: str) -> AnalysisResult:
+    rewrite = {"text": None, "explanation": None}
+    if action == "NO_OP":
+        rationale, trust_score = "This feedback is specific and constructive.", confidence
+    elif action == "FLAG" and reason == "gibberish":
+        rationale, trust_score = "This text doesn't read as feedback yet.", 0.0
+    elif action == "FLAG":
+        rationale, trust_score = "This feedback contains language that can't be shared as is.", 1 - confidence
+    else:
+        rationale, trust_score = "This feedback is a bit vague. Specifics help the author improve.", 0.5
+        rewrite = {
+            "text": "Consider naming the part of the course this refers to.\n"
+                    "Could you give an example of what worked or what didn't?",
+            "explanation": "Concrete details make the feedback actionable.",
+        }
+    return AnalysisResult(
+        ofnr_d={
+            "observation": None, "feeling": None, "need": None, "request": None,
+            "confidence": {"observation": 0, "feeling": 0, "need": 0, "request": 0}
+        },
+        trust_assessment={"trust_score": round(trust_score, 2), "flags": ["preclassified", reason]},
+        decision={"action": action, "rationale": rationale},
+        rewrite=rewrite,
+    )
+
+
+class PreClassifier:
+    def __init__(self, model: Optional[SoftmaxModel] = None, thresholds: dict = None, rules: set = None):
+        self.model = model
+        self.thresholds = thresholds if thresholds is not None else parse_thresholds(
+            os.getenv("TP_RIS_PRECLASSIFIER_THRESHOLDS", DEFAULT_THRESHOLDS))
+        self.rules = rules if rules is not None else parse_rules(
+            os.getenv("TP_RIS_PRECLASSIFIER_RULES", DEFAULT_RULES))
+        self.offloaded = Counter()
+        self.escalated = 0
+
+    @classmethod
+    def from_env(cls):
+        model = SoftmaxModel.load(PRECLASSIFIER_MODEL_PATH) if os.path.exists(PRECLASSIFIER_MODEL_PATH) else None
+        return cls(model)
+
+    def model_prediction(self, text: str):
+        """(action, confidence) from the model, or None without one."""
+        if self.model is None:
+            return None
+        proba = self.model.predict_proba(extract_features(text))
+        action = max(proba, key=proba.get)
+        return action, proba[action]
+
+    def predict(self, text: str):
+        """(action, confidence, reason) for a shortcut to take, else None. Rule hits have no confidence."""
+        ruled = rule_prediction(text)
+        if ruled is not None and ruled[1] in self.rules:
+            return ruled[0], None, ruled[1]
+        predicted = self.model_prediction(text)
+        if predicted is None:
+            return None
+        action, confidence = predicted
+        threshold = self.thresholds.get(action)
+        if threshold is None or confidence < threshold:
+            return None
+        return action, confidence, "model"
+
+    def classify(self, input_data: FeedbackInput) -> Optional[AnalysisResult]:
+        """A full AnalysisResult when confident enough, None to escalate to the LLM."""
+        prediction = self.predict(input_data.review_text)
+        if prediction is None:
+            self.escalated += 1
+            return None
+        action, confidence, reason = prediction
+        self.offloaded[action] += 1
+        DECISIONS.inc(action=action, source="preclassifier")
+        log_event("preclassified", action=action, reason=reason,
+                  confidence=round(confidence, 3) if confidence is not None else None)
+        return _shortcut_result(action, confidence, reason)
+
+    def stats(self) -> dict:
+        offloaded = sum(self.offloaded.values())
+        total = offloaded + self.escalated
+        return {
+            "model_loaded": self.model is not None,
+            "thresholds": self.thresholds,
+            "rules": sorted(self.rules),
+            "offloaded": dict(self.offloaded),
+            "escalated": self.escalated,
+            "offload_rate": round(offloaded / total, 3) if total else 0.0,
+        }
+
+
+def load_labeled(path: str) -> list:
+    """(review_text, action) pairs from a TP_RIS_RESULT_LOG file."""
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("review_text") and record.get("action"):
+                    samples.append((record["review_text"], record["action"]))
+    return samples
+
+
+def _is_holdout(text: str) -> bool:
+    # Deterministic 20% split that keeps duplicates of a text on the same side
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % 5 == 0
+
+
+def evaluate(classifier: PreClassifier, samples: list):
+    """
+    Agreement with the LLM and the share of traffic offloaded, reported separately for
+    rule hits and model predictions, plus a threshold sweep for the model.
+    """
+    print(f"{len(samples)} held-out reviews, rules {sorted(classifier.rules)}, thresholds {classifier.thresholds}")
+
+    rule_hits = Counter()
+    rule_agreed = Counter()
+    model_predictions = []  # ((action, confidence), label) for reviews the rules left to the model
+    for text, label in samples:
+        ruled = rule_prediction(text)
+        if ruled is not None:
+            rule_hits[ruled[1]] += 1
+            rule_agreed[ruled[1]] += ruled[0] == label
+            if ruled[1] in classifier.rules:
+                continue
+        predicted = classifier.model_prediction(text)
+        if predicted is not None:
+            model_predictions.append((predicted, label))
+
+    if os.path.exists(RULE_CASES_PATH):
+        with open(RULE_CASES_PATH, encoding="utf-8") as f:
+            cases = [json.loads(line) for line in f if line.strip()]
+        wrong = 0
+        for case in cases:
+            reason = (rule_prediction(case["text"]) or (None, None))[1]
+            if reason != case["expect"]:
+                wrong += 1
+                print(f"    {case['text']!r}: expected {case['expect'] or 'escalate'}, got {reason or 'escalate'}")
+        print(f"  rule cases: {len(cases) - wrong}/{len(cases)} as expected")
+
+    print("  rules (hits / agreement with LLM):")
+    for reason in RULE_REASONS:
+        state = "on" if reason in classifier.rules else "off, not offloaded"
+        print(f"    {reason:<22} {rule_hits[reason]:>5} hits, {rule_agreed[reason] / (rule_hits[reason] or 1):.1%} agree "
+              f"({state})")
+
+    offloaded = agreed = 0
+    per_action = Counter()
+    per_action_agreed = Counter()
+    for (action, confidence), label in model_predictions:
+        threshold = classifier.thresholds.get(action)
+        if threshold is not None and confidence >= threshold:
+            offloaded += 1
+            per_action[action] += 1
+            agreed += action == label
+            per_action_agreed[action] += action == label
+    rule_offloaded = sum(rule_hits[reason] for reason in classifier.rules)
+    total = rule_offloaded + offloaded
+    print(f"  model: offloaded {offloaded}/{len(samples)} ({offloaded / (len(samples) or 1):.1%}), "
+          f"agreement with LLM {agreed / (offloaded or 1):.1%}")
+    for action in SHORTCUT_ACTIONS:
+        if per_action[action]:
+            print(f"    {action:<22} {per_action[action]:>5} offloaded, {per_action_agreed[action] / per_action[action]:.1%} agree")
+    print(f"  total offloaded {total}/{len(samples)} ({total / (len(samples) or 1):.1%})")
+
+    print("  model threshold sweep (share of traffic offloaded / agreement) per action:")
+    for action in SHORTCUT_ACTIONS:
+        cells = []
+        for threshold in (0.5, 0.7, 0.8, 0.9, 0.95, 0.99):
+            taken = [(p[0], label) for p, label in model_predictions if p[0] == action and p[1] >= threshold]
+            share = len(taken) / (len(samples) or 1)
+            agreement = sum(a == label for a, label in taken) / (len(taken) or 1)
+            cells.append(f"{threshold}: {share:.1%}/{agreement:.0%}")
+        print(f"    {action:<22} " + "  ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the TP-RIS pre-classifier.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("log", help="JSONL of logged LLM results (TP_RIS_RESULT_LOG)")
+    parser.add_argument("--model", default=PRECLASSIFIER_MODEL_PATH)
+    parser.add_argument("--epochs", type=int, default=20)
+    args = parser.parse_args()
+
+    samples = load_labeled(args.log)
+    train = [(text, label) for text, label in samples if not _is_holdout(text)]
+    holdout = [(text, label) for text, label in samples if _is_holdout(text)]
+
+    if args.command == "train":
+        # Cases settled by enabled rules never reach the model, so it only learns from the rest
+        rules = PreClassifier(model=None).rules
+        model_samples = [(extract_features(text), label) for text, label in train
+                         if (rule_prediction(text) or (None, None))[1] not in rules]
+        print(f"Training on {len(model_samples)} reviews ({Counter(l for _, l in model_samples)})")
+        model = SoftmaxModel().fit(model_samples, epochs=args.epochs)
+        model.save(args.model)
+        print(f"Saved model to {args.model}")
+        evaluate(PreClassifier(model), holdout)
+    else:
+        model = SoftmaxModel.load(args.model) if os.path.exists(args.model) else None
+        evaluate(PreClassifier(model), holdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Routes generations across a pool of model servers.
+
+The pool comes from TP_RIS_BACKENDS, either inline JSON or the path to a JSON
+file, holding a list of backends:
+
+    [{"name": "gpu1", "kind": "ollama", "url": "http://gpu1:11434", "model": "gpt-oss:20b", "max_concurrency": 2},
+     {"name": "gpu2", "kind": "openai", "url": "http://gpu2:8000", "model": "openai/gpt-oss-20b"},
+     {"name": "small", "url": "http://localhost:11434", "model": "gemma3:4b", "tier": "fallback"}]
+
+Without it the pool is the single Ollama instance at OLLAMA_URL, as before.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from contextlib import aclosing
+
+import httpx
+
+from llm_client import MAX_CONCURRENCY, MAX_QUEUE_SIZE, AdmissionQueue, OllamaClient, OpenAIClient, QueueFullError
+from metrics import BACKEND_REQUESTS, CIRCUIT_BREAKER_OPENED
+from tracing import log_event
+
+BACKENDS_CONFIG = os.getenv("TP_RIS_BACKENDS") or None
+# Seconds between health probes of every backend.
+HEALTH_CHECK_INTERVAL = float(os.getenv("TP_RIS_HEALTH_CHECK_INTERVAL", "10"))
+# Consecutive failures that open a backend's circuit breaker, and how long it stays open
+# before one trial request is let through.
+BREAKER_FAILURES = int(os.getenv("TP_RIS_BREAKER_FAILURES", "3"))
+BREAKER_RESET = float(os.getenv("TP_RIS_BREAKER_RESET", "30"))
+# Send a request to a fallback-tier backend rather than wait longer than this for a primary one.
+FALLBACK_WAIT = float(os.getenv("TP_RIS_FALLBACK_WAIT", "20"))
+
+CLIENT_KINDS = {"ollama": OllamaClient, "openai": OpenAIClient}
+TIERS = ("primary", "fallback")
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; while open, lets one trial request through per reset_timeout."""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.times_opened = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half_open":
+            # This request is the trial; everyone else waits for the next window
+            self.opened_at = time.monotonic()
+        return state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if it opened the breaker."""
+        self.failures += 1
+        if self.opened_at is not None:
+            # Failed trial: stay open for another window
+            self.opened_at = time.monotonic()
+            return False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            return True
+        return False
+
+
+class Backend:
+    """One model server in the pool, with its own admission queue, health state and circuit breaker."""
+
+    def __init__(self, name: str, url: str, model: str, kind: str = "ollama", tier: str = "primary",
+                 max_concurrency: int = MAX_CONCURRENCY, max_queue_size: int = MAX_QUEUE_SIZE,
+                 api_key: str = None, queue: AdmissionQueue = None):
+        if kind not in CLIENT_KINDS:
+            raise ValueError(f"Backend {name!r}: unknown kind {kind!r}, expected one of {sorted(CLIENT_KINDS)}")
+        if tier not in TIERS:
+            raise ValueError(f"Backend {name!r}: unknown tier {tier!r}, expected one of {TIERS}")
+        self.name, self.model, self.kind, self.tier = name, model, kind, tier
+        client_cls = CLIENT_KINDS[kind]
+        base_url = url.rstrip("/")
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
+        self.client = client_cls(base_url + client_cls.GENERATE_PATH,
+                                 queue or AdmissionQueue(max_concurrency, max_queue_size), headers=headers)
+        self.probe_url = base_url + client_cls.PROBE_PATH
+        self.breaker = CircuitBreaker()
+        self.healthy = True
+        self.last_error = None
+
+    @property
+    def queue(self) -> AdmissionQueue:
+        return self.client.queue
+
+    @property
+    def outstanding(self) -> int:
+        return self.queue.in_flight + self.queue.queued
+
+    def load(self) -> float:
+        return self.outstanding / self.queue.max_concurrency
+
+    def available(self) -> bool:
+        return self.healthy and self.breaker.state != "open"
+
+    def saturated(self) -> bool:
+        """True if this backend's queue would reject a new request."""
+        return self.queue.in_flight >= self.queue.max_concurrency and self.queue.queued >= self.queue.max_queue_size
+
+    def expected_wait(self) -> float:
+        """Rough seconds a new request would wait for a slot."""
+        if self.queue.in_flight < self.queue.max_concurrency:
+            return 0.0
+        return (self.queue.queued + 1) / self.queue.max_concurrency * self.queue.avg_service_time
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "model": self.model,
+            "tier": self.tier,
+            "healthy": self.healthy,
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "last_error": self.last_error,
+            **self.client.stats(),
+        }
+
+
+class LLMRouter:
+    """
+    Spreads generations over a pool of backends; has the same generate/generate_stream
+    interface as OllamaClient. Primary backends are picked by fewest outstanding
+    requests per slot, skipping ones that failed their last health probe or whose
+    circuit breaker is open. When every primary is down, full, or would keep the
+    request waiting longer than fallback_wait, a fallback-tier backend serves it
+    instead. A connection failure is retried on the next backend as long as nothing
+    has been streamed yet.
+    """
+
+    def __init__(self, backends: list, health_check_interval: float = HEALTH_CHECK_INTERVAL,
+                 fallback_wait: float = FALLBACK_WAIT):
+        if not backends:
+            raise ValueError("At least one backend is required")
+        names = [backend.name for backend in backends]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Backend names must be unique, got {names}")
+        self.backends = backends
+        # What a cached result depends on: fallback answers aren't cached, so only the primary models
+        self.primary_models = tuple(sorted({backend.model for backend in backends if backend.tier == "primary"}))
+        self.health_check_interval = health_check_interval
+        self.fallback_wait = fallback_wait
+        self.rejected = 0
+        self.fallback_served = 0
+        self._probe_client = httpx.AsyncClient(timeout=httpx.Timeout(5.0))
+        self._probe_task = None
+
+    @classmethod
+    def from_env(cls, default_url: str, default_model: str, queue: AdmissionQueue = None) -> "LLMRouter":
+        """Build the pool from TP_RIS_BACKENDS, or a single Ollama backend at default_url using queue."""
+        if not BACKENDS_CONFIG:
+            base_url = default_url.removesuffix(OllamaClient.GENERATE_PATH)
+            return cls([Backend("default", base_url, default_model, queue=queue)])
+        config = BACKENDS_CONFIG
+        if not config.lstrip().startswith("["):
+            with open(config) as f:
+                config = f.read()
+        backends = []
+        for i, entry in enumerate(json.loads(config)):
+            entry = dict(entry)
+            api_key_env = entry.pop("api_key_env", None)
+            entry.setdefault("name", f"{entry.get('kind', 'ollama')}-{i}")
+            entry.setdefault("model", default_model)
+            backends.append(Backend(api_key=os.getenv(api_key_env) if api_key_env else None, **entry))
+        return cls(backends)
+
+    def start(self):
+        """Start periodic health probes; call from within the running event loop."""
+        if self._probe_task is None:
+            self._probe_task = asyncio.ensure_future(self._probe_loop())
+
+    async def _probe(self, backend: Backend):
+        try:
+            response = await self._probe_client.get(backend.probe_url)
+            response.raise_for_status()
+            healthy, error = True, None
+        except httpx.HTTPError as e:
+            healthy, error = False, str(e) or type(e).__name__
+        if healthy != backend.healthy:
+            log_event("backend_health_changed", logging.INFO if healthy else logging.WARNING,
+                      backend=backend.name, healthy=healthy, error=error)
+        backend.healthy = healthy
+        if error:
+            backend.last_error = error
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+            await asyncio.sleep(self.health_check_interval)
+
+    def _pick(self, tried: set) -> Backend:
+        candidates = [b for b in self.backends if b.name not in tried and b.available()]
+        fallbacks = [b for b in candidates if b.tier == "fallback" and not b.saturated()]
+        primaries = [b for b in candidates if b.tier == "primary"]
+        ready = [b for b in primaries
+                 if not b.saturated() and (not fallbacks or b.expected_wait() <= self.fallback_wait)]
+        # With nowhere else to go, saturated primaries still get the request so their queue answers the 503
+        pool = ready or fallbacks or primaries
+        if not pool:
+            return None
+        backend = min(pool, key=lambda b: (b.load(), b.outstanding))
+        backend.breaker.allow()
+        return backend
+
+    def _next_backend(self, tried: set, last_error: Exception) -> Backend:
+        backend = self._pick(tried)
+        if backend is not None:
+            tried.add(backend.name)
+            return backend
+        if isinstance(last_error, QueueFullError) or last_error is None:
+            self.rejected += 1
+        if last_error is not None:
+            raise last_error
+        raise QueueFullError(max(1, math.ceil(self.health_check_interval)))
+
+    def _record_success(self, backend: Backend):
+        backend.breaker.record_success()
+        BACKEND_REQUESTS.inc(backend=backend.name, model=backend.model, outcome="success")
+        if backend.tier == "fallback":
+            self.fallback_served += 1
+            log_event("served_by_fallback", backend=backend.name, model=backend.model)
+
+    def _record_failure(self, backend: Backend, error: Exception):
+        backend.last_error = str(error) or type(error).__name__
+        BACKEND_REQUESTS.inc(backend=backend.name, model=backend.model, outcome="failure")
+        log_event("backend_failed", logging.WARNING, backend=backend.name, error=backend.last_error)
+        if backend.breaker.record_failure():
+            CIRCUIT_BREAKER_OPENED.inc(backend=backend.name)
+            log_event("circuit_breaker_opened", logging.WARNING, backend=backend.name,
+                      failures=backend.breaker.failures)
+
+    @staticmethod
+    def _tag(backend: Backend, data: dict) -> dict:
+        data.update(model=backend.model, backend=backend.name, fallback=backend.tier == "fallback")
+        return data
+
+    async def generate(self, payload: dict) -> dict:
+        """Like OllamaClient.generate; the response also carries the serving backend and whether it was a fallback."""
+        tried, last_error = set(), None
+        while True:
+            backend = self._next_backend(tried, last_error)
+            try:
+                result_data = await backend.client.generate({**payload, "model": backend.model})
+            except QueueFullError as e:
+                BACKEND_REQUESTS.inc(backend=backend.name, model=backend.model, outcome="rejected")
+                last_error = e
+                continue
+            except httpx.HTTPError as e:
+                self._record_failure(backend, e)
+                # A read timeout already used up the request's time budget; don't spend it again elsewhere
+                if isinstance(e, httpx.ReadTimeout):
+                    raise
+                last_error = e
+                continue
+            self._record_success(backend)
+            return self._tag(backend, result_data)
+
+    async def generate_stream(self, payload: dict):
+        """Like OllamaClient.generate_stream; every chunk carries the serving backend and whether it was a fallback."""
+        tried, last_error = set(), None
+        while True:
+            backend = self._next_backend(tried, last_error)
+            streamed = False
+            try:
+                async with aclosing(backend.client.generate_stream({**payload, "model": backend.model})) as chunks:
+                    async for chunk in chunks:
+                        streamed = True
+                        yield self._tag(backend, chunk)
+            except QueueFullError as e:
+                BACKEND_REQUESTS.inc(backend=backend.name, model=backend.model, outcome="rejected")
+                last_error = e
+                continue
+            except httpx.HTTPError as e:
+                self._record_failure(backend, e)
+                if streamed or isinstance(e, httpx.ReadTimeout):
+                    raise
+                last_error = e
+                continue
+            self._record_success(backend)
+            return
+
+    async def generate_on_each(self, payload: dict, record_stats: bool = True) -> list:
+        """Send payload to every backend at once; returns each response, or the exception it raised."""
+        return await asyncio.gather(
+            *(backend.client.generate({**payload, "model": backend.model}, record_stats=record_stats)
+              for backend in self.backends),
+            return_exceptions=True)
+
+    def timing_stats(self) -> dict:
+        """OllamaClient.timing_stats, averaged over the whole pool."""
+        clients = [backend.client for backend in self.backends]
+        samples = sum(client._eval_samples for client in clients) or 1
+        totals = {field: sum(client.ollama_totals[field] for client in clients)
+                  for field in clients[0].ollama_totals}
+        return {
+            "generations": sum(client._eval_samples for client in clients),
+            "avg_load_ms": round(totals["load_duration"] / samples / 1e6, 1),
+            "avg_prompt_eval_tokens": round(totals["prompt_eval_count"] / samples, 1),
+            "avg_prompt_eval_ms": round(totals["prompt_eval_duration"] / samples / 1e6, 1),
+            "avg_eval_tokens": round(totals["eval_count"] / samples, 1),
+            "avg_eval_ms": round(totals["eval_duration"] / samples / 1e6, 1),
+        }
+
+    def stats(self) -> dict:
+        """Pool-wide totals in the same shape as OllamaClient.stats, plus per-backend detail."""
+        per_backend = [backend.stats() for backend in self.backends]
+        totals = {field: sum(stats[field] for stats in per_backend)
+                  for field in ("max_concurrency", "max_queue_size", "in_flight", "queued", "completed",
+                                "cancelled_generations", "cancelled_queued", "estimated_tokens_saved")}
+        return {
+            **totals,
+            "rejected": self.rejected,
+            "backends_available": sum(1 for backend in self.backends if backend.available()),
+            "fallback_served": self.fallback_served,
+            "backends": per_backend,
+        }
+
+    async def aclose(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+        await self._probe_client.aclose()
+        for backend in self.backends:
+            await backend.client.aclose()
@@ -0,0 +1,54 @@
+"""
+Regression checks for parsing model output: the corpus in benchmarks/corpus,
+fuzzed copies of it, and a bound on how extraction time grows with length.
+
+Run from backend/:
+    python -m pytest -q
+"""
+import os
+import sys
+import timeit
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+import bench_extract_json as bench  # noqa: E402
+from pipeline import JSONFieldStream, extract_json_object, validate_streamed_field  # noqa: E402
+
+CORPUS = bench.load_corpus()
+
+
+@pytest.mark.parametrize("entry", CORPUS, ids=[entry["name"] for entry in CORPUS])
+def test_corpus_decision(entry):
+    assert bench.decision_action(extract_json_object(entry["output"])) == entry["expect_action"]
+
+
+def test_fuzzed_outputs_never_raise():
+    assert bench.fuzz(CORPUS, 1000, seed=0) == 0
+
+
+@pytest.mark.parametrize("name", ["preamble_chatter", "stray_open_brace_before", "stray_quote_before",
+                                  "truncated_first_attempt", "quote_in_chatter"])
+def test_streamed_decision_despite_chatter(name):
+    entry = next(entry for entry in CORPUS if entry["name"] == name)
+    stream = JSONFieldStream()
+    streamed = {}
+    for i in range(0, len(entry["output"]), 7):
+        for key, value in stream.feed(entry["output"][i:i+7]):
+            value = validate_streamed_field(key, value)
+            if value is not None:
+                streamed[key] = value
+    assert streamed["decision"]["action"] == entry["expect_action"]
+
+
+@pytest.mark.parametrize("build", [bench.rambling_output, bench.stray_brace_output, bench.invalid_object_output])
+def test_extraction_time_grows_linearly(build):
+    def seconds(target_len):
+        text = build(CORPUS, target_len)
+        return min(timeit.repeat(lambda: extract_json_object(text), number=1, repeat=3))
+
+    short, long = seconds(4_000), seconds(32_000)
+    # 8x the text; quadratic behaviour would show as ~64x
+    assert long < 20 * short + 0.01
+
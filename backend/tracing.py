@@ -0,0 +1,76 @@
+"""
+Structured per-request trace logging.
+
+Every HTTP request gets a request id (taken from X-Request-ID or generated),
+which is echoed back in the response and attached to every event logged while
+serving it, including from tasks the request spawns.
+"""
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from metrics import REQUEST_DURATION
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+logger = logging.getLogger("tp_ris")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.getenv("TP_RIS_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    """Log one JSON line: {"ts", "level", "event", "request_id", **fields}."""
+    if not logger.isEnabledFor(level):
+        return
+    record = {
+        "ts": round(time.time(), 3),
+        "level": logging.getLevelName(level).lower(),
+        "event": event,
+        "request_id": request_id_var.get(),
+        **fields,
+    }
+    logger.log(level, json.dumps(record, default=str))
+
+
+class RequestTracingMiddleware:
+    """ASGI middleware that assigns request ids and records total request time, streamed bodies included."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            duration = time.perf_counter() - started
+            # Label by route template (e.g. /analyze-feedback/batch/{job_id}) so series stay bounded
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            REQUEST_DURATION.observe(duration, endpoint=endpoint, status=status["code"])
+            log_event("request_finished", method=scope["method"], path=scope["path"],
+                      status=status["code"], duration_ms=round(duration * 1000, 1))
+            request_id_var.reset(token)
@@ -46,6 +46,8 @@ export function useAnalysis({ initialText = '' }: UseAnalysisProps) {
     const timeoutRef = useRef<ReturnType<typeof setTimeout> | null>(null);
     const lastRequestTimeRef = useRef<number>(0);
     const abortControllerRef = useRef<AbortController | null>(null);
+    // Lets the backend cancel our older in-flight analysis when a newer one arrives
+    const sessionIdRef = useRef(`${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`);
 
     const MIN_CHARS = 80;
     const RATE_LIMIT_MS = 2000;
@@ -89,7 +91,8 @@ export function useAnalysis({ initialText = '' }: UseAnalysisProps) {
             const response = await axios.post('/api/analyze-feedback', {
                 review_text: currentText,
             }, {
-                signal: abortControllerRef.current.signal
+                signal: abortControllerRef.current.signal,
+                headers: { 'X-Session-Id': sessionIdRef.current }
             });
 
             console.log('[useAnalysis] Response received:', response.data);
@@ -110,6 +113,8 @@ export function useAnalysis({ initialText = '' }: UseAnalysisProps) {
         } catch (error) {
             if (axios.isCancel(error)) {
                 console.log('[useAnalysis] Request canceled');
+            } else if (axios.isAxiosError(error) && error.response?.status === 409) {
+                console.log('[useAnalysis] Request superseded by a newer one');
             } else {
                 console.error('[useAnalysis] Analysis error:', error);
                 setStatus('error');
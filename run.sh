@@ -101,7 +101,7 @@ echo "[6/6] Starting Backend Service..."
 fuser -k 8000/tcp 2>/dev/null || true
 cd "$BACKEND_DIR"
 source venv/bin/activate
-nohup uvicorn main:app --host 127.0.0.1 --port 8000 > /tmp/backend.log 2>&1 &
+TP_RIS_MODEL="$MODEL_NAME" nohup uvicorn main:app --host 127.0.0.1 --port 8000 > /tmp/backend.log 2>&1 &
 
 echo "Waiting for backend to verify health..."
 sleep 5